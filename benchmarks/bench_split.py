@@ -0,0 +1,76 @@
+"""
+Benchmark protoci.split on synthetic dependency graphs.
+
+Usage:
+
+python benchmarks/bench_split.py [-n 5000] [-width 50] [-fanout 4]
+
+Builds a layered, diamond heavy DAG of n packages (each package
+depends on fanout packages of the next few layers) and times the
+descendant closures and split_graph on it.
+"""
+from __future__ import print_function, division
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import networkx as nx
+
+from protoci.split import (descendant_bits, bits_to_nodes,
+                           successors_iter, split_graph)
+
+
+def synthetic_graph(n, width, fanout, seed=0):
+    rand = random.Random(seed)
+    g = nx.DiGraph()
+    names = ['pkg{:05d}'.format(i) for i in range(n)]
+    g.add_nodes_from(names)
+    for i, name in enumerate(names):
+        layer = i // width
+        lo, hi = (layer + 1) * width, min(n, (layer + 4) * width)
+        if lo >= hi:
+            continue
+        for dep in rand.sample(range(lo, hi), min(fanout, hi - lo)):
+            g.add_edge(name, names[dep])
+    return g
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print('{:<28}{:.3f}s'.format(label, time.time() - start))
+    return result
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Time split_graph on a synthetic graph")
+    parser.add_argument('-n', type=int, default=5000,
+                        help="Number of packages. Default: %(default)s")
+    parser.add_argument('-width', type=int, default=50,
+                        help="Packages per layer. Default: %(default)s")
+    parser.add_argument('-fanout', type=int, default=4,
+                        help="Build deps per package. Default: %(default)s")
+    parser.add_argument('-t', '--targetnum', type=int, default=10)
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    g = synthetic_graph(args.n, args.width, args.fanout)
+    print('{} nodes, {} edges'.format(g.number_of_nodes(), g.number_of_edges()))
+    toposort = timed('topological_sort', nx.topological_sort, g)
+    bits = timed('descendant_bits', descendant_bits, g, toposort)
+    closure = timed('bits_to_nodes (roots)',
+                    lambda: [bits_to_nodes(bits[n], toposort)
+                             for n in toposort[:args.width]])
+    dfs = timed('successors_iter (roots)',
+                lambda: [successors_iter(g, n) for n in toposort[:args.width]])
+    assert [set(c) for c in closure] == [set(d) for d in dfs]
+    split_file = os.path.join(tempfile.mkdtemp(), 'package_tree.js')
+    timed('split_graph', split_graph, g, args.targetnum, split_file)
+
+
+if __name__ == '__main__':
+    main()
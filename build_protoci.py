@@ -13,75 +13,137 @@ where:
     and
     anaconda_user is the upload user
 
+Every python version is built at the same time, each in its own conda-bld
+root and envs dir (<tmp>/py<ver>/conda-bld and envs, in a temporary
+directory outside path, which conda build copies into the package;
+conda-build 1.x makes its _build and _test prefixes in the first envs
+dir) and converted to all
+platforms (into <tmp>/py<ver>/<platform>) as soon as its build finishes.
+The packages of all versions are uploaded together at the end, and only
+if every build and conversion worked.
 """
 import os
 import shutil
 from subprocess import *
 import sys
-import time
+import tempfile
+import threading
+
+from protoci.buildroot import conda_pkgs_dir
 
 dists = ['linux-32','linux-64','osx-64','win-32', 'win-64']
+PY_VERSIONS = ('27', '34', '35')
+_print_lock = threading.Lock()
+
+
+def say(prefix, *args):
+    with _print_lock:
+        print(prefix, *args)
+        sys.stdout.flush()
+
+
+def run(args, prefix, **kwargs):
+    '''Run args, printing its output as it comes; return (returncode, lines)'''
+    proc = Popen(args, stdout=PIPE, stderr=STDOUT, **kwargs)
+    out = []
+    # readline blocks until a line (or EOF) arrives, so no polling is needed
+    for line in iter(proc.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip()
+        out.append(line)
+        say(prefix, line)
+    proc.stdout.close()
+    return proc.wait(), out
+
+
+def build_one(path, CONDA_PY, results, root):
+    '''
+    Build and convert protoci for CONDA_PY under root;
+    results[CONDA_PY] = (returncode, files)
+    '''
+    prefix = '[py{}]'.format(CONDA_PY)
+    work = os.path.join(root, 'py' + CONDA_PY)
+    os.makedirs(work)
+    env = os.environ.copy()
+    env['CONDA_PY'] = CONDA_PY
+    # A conda-bld root and envs dir per version, so builds running at
+    # once do not share work, output, build and test directories
+    env['CONDA_BLD_PATH'] = os.path.join(work, 'conda-bld')
+    env['CONDA_ENVS_PATH'] = os.path.join(work, 'envs')
+    if not env.get('CONDA_PKGS_DIRS'):
+        # Older conda would use an empty cache next to the envs dir
+        pkgs_dir = conda_pkgs_dir()
+        if pkgs_dir:
+            env['CONDA_PKGS_DIRS'] = pkgs_dir
+    args = ['conda', 'build', '.','--no-anaconda-upload']
+    say(prefix, args)
+    ret, out = run(args, prefix, cwd=path, env=env)
+    if ret:
+        say(prefix, 'FAILED conda build . ', CONDA_PY)
+        results[CONDA_PY] = (ret, [])
+        return
+    say(prefix, "conda build . (OK) for", CONDA_PY)
+    files = []
+    for line in out:
+        if line.startswith("#") and 'anaconda' in line and 'upload' in line:
+            f = line.split()[-1]
+            if os.path.exists(f):
+                files.append(f)
+    if not files:
+        say(prefix, 'No package found in the conda build output')
+        results[CONDA_PY] = (1, [])
+        return
+    say(prefix, 'convert: ', files)
+    for file in files:
+        ret, out = run(['conda', 'convert', '--platform', 'all', file,
+                        '--output-dir', work],
+                       prefix, cwd=path, env=env)
+        if ret:
+            say(prefix, 'Failed on conda convert')
+            results[CONDA_PY] = (ret, [])
+            return
+        say(prefix, "Conversion ok for", file)
+    converted = []
+    for dist in dists:
+        dist_dir = os.path.join(work, dist)
+        if os.path.isdir(dist_dir):
+            converted.extend(os.path.join(dist_dir, f)
+                             for f in sorted(os.listdir(dist_dir)))
+    results[CONDA_PY] = (0, converted)
+
+
 def build_protoci(input_args):
     path = input_args.path
-    env = os.environ.copy()
-    retvals = []
-    for CONDA_PY in ('27', '34', '35'):
-        print('Clean build dirs')
-        for dist_dir in dists:
-            dist_dir = os.path.join(path, dist_dir)
-            if os.path.exists(dist_dir):
-                shutil.rmtree(dist_dir)
-        env['CONDA_PY'] = CONDA_PY
-        args = ['conda', 'build', '.','--no-anaconda-upload']
-        print(args)
-        print("CONDA_PY", CONDA_PY)
-        proc = Popen(args,
-                     cwd=path, stdout=PIPE,
-                     stderr=STDOUT, env=env)
-        out = []
-        while proc.poll() is None:
-            out.append(proc.stdout.readline().rstrip())
-            print(out[-1])
-            time.sleep(0.02)
-        pos = len(out)
-        out.extend(proc.stdout.readlines())
+    versions = getattr(input_args, 'py', None) or PY_VERSIONS
+    results = {}
+    root = tempfile.mkdtemp(prefix='build-protoci-')
+    print('Building in', root)
+    try:
+        threads = [threading.Thread(target=build_one,
+                                    args=(path, v, results, root),
+                                    name='py' + v)
+                   for v in versions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        retvals = [results.get(v, (1, []))[0] for v in versions]
+        failed = [v for v, ret in zip(versions, retvals) if ret]
+        if failed:
+            print('FAILED for CONDA_PY', ', '.join(failed), '- nothing uploaded')
+            return max(retvals)
+        files = [f for v in versions for f in results[v][1]]
+        if not files:
+            print('Nothing to upload')
+            return 1
+        print('Upload {} packages'.format(len(files)))
+        proc = Popen(['anaconda', 'upload',
+                      '--user', input_args.user, '--force'] + files,
+                     cwd=path)
         if proc.wait():
-            print('FAILED conda build . ', CONDA_PY)
-            print(out)
-            return proc.poll()
-        print("conda build . (OK) for", CONDA_PY)
-        files = []
-        for line in out:
-            if line.startswith("#") and 'anaconda' in line and 'upload' in line:
-                f = line.split()[-1]
-                if os.path.exists(f):
-                    files.append(f)
-        print('convert: ', files)
-        for file in files:
-            proc = Popen(['conda', 'convert', '--platform', 'all', file],
-                  stdout=PIPE, stderr=STDOUT, cwd=path, env=env)
-            proc.wait()
-            out = proc.stdout.read().decode()
-            retvals.append(proc.poll())
-            if retvals[-1]:
-                print('Failed on conda convert')
-                print(out)
-            else:
-                print("Conversion ok for", file)
-                for dist in dists:
-                    dist_dir = os.path.join(path, dist)
-                    for dist_file in os.listdir(dist_dir):
-                        env = os.environ.copy()
-                        env['CONDA_PY'] = CONDA_PY
-                        proc = Popen(['anaconda', 'upload',
-                               '--user', input_args.user,
-                               os.path.abspath(os.path.join(dist_dir, dist_file)),
-                               '--force',],
-                               cwd=path)
-                        if proc.wait():
-                            print('Failed on anaconda upload')
-                            sys.exit(proc.poll())
-    return 1 if not len(retvals) else max(retvals)
+            print('Failed on anaconda upload')
+        return proc.poll()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
 
 def cli():
     import argparse
@@ -90,6 +152,10 @@ def cli():
                         help="Path to repo to conda build on locally")
     parser.add_argument('user',
                         help="anaconda user")
+    parser.add_argument('-py',
+                        nargs="+",
+                        default=list(PY_VERSIONS),
+                        help="CONDA_PY versions to build. Default: %(default)s")
     return parser.parse_args()
 
 def main():
@@ -97,4 +163,4 @@ def main():
     sys.exit(build_protoci(args))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,20 +2,58 @@
 from __future__ import print_function, division
 
 import argparse
-from collections import defaultdict
+from collections import defaultdict, deque
 import datetime
+import hashlib
 import json
+import multiprocessing
 import psutil
 import os
 import shutil
 import subprocess
+import threading
 import time
 import networkx as nx
 import sys
 
+import conda_build
 from conda_build.metadata import parse, MetaData
 
-CONDA_BUILD_CACHE=os.environ.get("CONDA_BUILD_CACHE")
+from protoci import cgroup as build_cgroup
+from protoci.build_cache import BuildStore, build_keys
+from protoci.buildroot import BuildRoot, pkgs_environ
+from protoci.channel import LocalChannel
+from protoci.checkpoint import Checkpoint
+from protoci.graph_snapshot import GraphSnapshot
+from protoci.disk import DiskTracker
+from protoci.recipe_cache import RecipeCache
+from protoci import report as build_report
+from protoci.resources import ResourceProfile
+from protoci.scheduler import BuildScheduler, critical_path_order
+from protoci.timeline import Series, Timeline
+
+PROTOCI_HOME = os.environ.get("PROTOCI_HOME",
+                              os.path.join(os.path.expanduser('~'), '.protoci'))
+# Where results of successful builds are kept (see protoci.build_cache)
+CONDA_BUILD_CACHE = os.environ.get("CONDA_BUILD_CACHE",
+                                   os.path.join(PROTOCI_HOME, 'build_cache'))
+RESOURCE_PROFILE = os.path.join(PROTOCI_HOME, 'resource_profile.json')
+RECIPE_CACHE_DIR = os.path.join(PROTOCI_HOME, 'recipe_cache')
+GRAPH_SNAPSHOT_DIR = os.path.join(PROTOCI_HOME, 'graphs')
+# Environment variables that change how recipes render
+RENDER_ENV_VARS = ('CONDA_PY', 'CONDA_NPY', 'CONDA_PERL', 'CONDA_LUA', 'CONDA_R')
+# First interval (in seconds) between PopenWrapper resource samples
+SAMPLE_START = 0.05
+# Disk is scanned on every DISK_SAMPLE_EVERY-th resource sample
+DISK_SAMPLE_EVERY = 5
+# Lines of a captured build log kept in memory (printed when it fails)
+LOG_TAIL = 200
+# Seconds to wait for the rest of a build's output after it exits; a
+# background process it left running may hold the pipe open forever
+OUTPUT_GRACE = 5
+# Seconds between "still building" lines; anaconda-build kills a job
+# after 120s without output
+HEARTBEAT = 60
 
 class PopenWrapper(object):
     # Small wrapper around subprocess.Popen to allow memory usage monitoring
@@ -29,62 +67,208 @@ class PopenWrapper(object):
         # after here.
         self.returncode = 173
         self.disk = None
+        # Package file made by the build (see make_pkg)
+        self.output = None
+        # Only measured with a cgroup
+        self.cpu_time = None
+        self.io_read = None
+        self.io_write = None
+        # Only with log_file: where the output went and its last lines
+        self.log_file = None
+        self.tail = deque(maxlen=LOG_TAIL)
 
         self._execute(*args, **kwargs)
 
     def _execute(self, *args, **kwargs):
-        # The polling interval (in seconds)
+        # The longest interval (in seconds) between resource samples.
+        # Sampling starts faster and backs off to this; completion is
+        # noticed right away regardless.
         time_int = kwargs.pop('time_int', 1)
+        # A protoci.cgroup.BuildCgroup to run (and measure) the build in
+        cgroup = kwargs.pop('cgroup', None)
+        # A protoci.disk.DiskTracker of the directories the build writes
+        disk = kwargs.pop('disk', None)
+        # A protoci.timeline.Series to add every sample to
+        series = kwargs.pop('series', None)
+        # File to write stdout and stderr to instead of inheriting them
+        log_file = kwargs.pop('log_file', None)
+        # Seconds between "still building" lines, or None for none
+        heartbeat = kwargs.pop('heartbeat', None)
+        name = kwargs.pop('name', None) or str(args[0])
 
-        # Create a process of this (the parent) process
-        parent = psutil.Process(os.getpid())
-        initial_usage = psutil.disk_usage(sys.prefix).used
-
+        if cgroup is not None:
+            args = (cgroup.wrap(args[0]),) + args[1:]
+        if log_file is not None:
+            self.log_file = log_file
+            kwargs['stdout'] = subprocess.PIPE
+            kwargs['stderr'] = subprocess.STDOUT
+            # Unbuffered, so the pipe can be closed while it is being read
+            kwargs['bufsize'] = 0
         # Using the convenience Popen class provided by psutil
         start_time = time.time()
         _popen = psutil.Popen(*args, **kwargs)
-        try:
-            while _popen.is_running():
-                #We need to get all of the children of our process since our process spawns other processes
-                # Collect all of the child processes
+        done = threading.Event()
+        reader = None
+        if log_file is not None:
+            reader = threading.Thread(target=self._read_output,
+                                      args=(_popen.stdout, log_file))
+            reader.daemon = True
+            reader.start()
+        if series is not None:
+            series.start = start_time
+            # psutil.Process of each pid, for cpu_percent between samples
+            self._procs = {}
 
-                try:
-                    # We use the parent process to get mem usage of all spawned processes
-                    child_pids = [_.memory_info() for _ in parent.children(recursive=True) if _.is_running()]
-                    # Sum the memory usage of all the children together (2D columnwise sum)
-                    rss, vms = [sum(_) for _ in zip(*child_pids)]
+        def wait():
+            # Blocks in waitpid, so the exit is seen as soon as it happens
+            try:
+                self.returncode = _popen.wait()
+            finally:
+                self.elapsed = time.time() - start_time
+                done.set()
 
-                    self.rss = max(rss, self.rss)
-                    self.vms = max(vms, self.vms)
+        waiter = threading.Thread(target=wait)
+        waiter.daemon = True
+        waiter.start()
+        interval = min(SAMPLE_START, time_int)
+        samples = 0
+        last_beat = start_time
+        try:
+            while not done.is_set():
+                if heartbeat and time.time() - last_beat >= heartbeat:
+                    last_beat = time.time()
+                    self._heartbeat(name, last_beat - start_time)
+                current = self._sample(_popen, cgroup, series)
+                if disk is not None and not samples % DISK_SAMPLE_EVERY:
+                    self.disk = disk.sample()
+                if series is not None:
+                    rss, cpu, procs = current
+                    series.add(time.time(), rss, cpu, procs=procs,
+                               disk=disk.last if disk is not None else None)
+                samples += 1
+                done.wait(interval)
+                interval = min(interval * 2, time_int)
+            if disk is not None:
+                # Files still being written at earlier scans are only
+                # measured in full now
+                self.disk = disk.sample(full=True)
+        except KeyboardInterrupt:
+            try:
+                _popen.kill()
+            except psutil.NoSuchProcess:
+                pass
+            raise
+        finally:
+            if cgroup is not None:
+                self._read_cgroup(cgroup)
+        waiter.join()
+        if reader is not None:
+            reader.join(OUTPUT_GRACE)
+            if reader.is_alive():
+                print('Output of {} still open after it exited; '
+                      'closing it'.format(name))
+            try:
+                _popen.stdout.close()
+            except (IOError, OSError):
+                pass
 
-                    # Get disk usage
-                    used_disk = initial_usage - psutil.disk_usage(sys.prefix).used
-                    self.disk = max(used_disk, self.disk)
+    def _read_output(self, stream, log_file):
+        # Runs in its own thread, so a chatty build never blocks on a
+        # full pipe and sampling never waits for output
+        partial = b''
+        with open(log_file, 'wb') as log:
+            try:
+                for chunk in iter(lambda: stream.read(1 << 16), b''):
+                    log.write(chunk)
+                    log.flush()
+                    lines = (partial + chunk).split(b'\n')
+                    partial = lines.pop()
+                    self.tail.extend(line + b'\n' for line in lines)
+            except (ValueError, IOError, OSError):
+                # _execute closed the pipe (see OUTPUT_GRACE)
+                pass
+            if partial:
+                self.tail.append(partial)
 
-                except psutil.AccessDenied as e:
-                    if _popen.status() == psutil.STATUS_ZOMBIE:
-                        _popen.wait()
+    def _heartbeat(self, name, elapsed):
+        line = '... still building {} ({:.0f}m, rss {})'.format(
+               name, elapsed / 60, bytes2human(self.rss or 0))
+        if self.tail:
+            last = self.tail[-1].decode('utf-8', 'replace').strip()
+            line += ': ' + last[:100]
+        print(line)
+        sys.stdout.flush()
 
-                time.sleep(time_int)
-                self.elapsed = time.time() - start_time
-                self.returncode = _popen.poll()
-                if _popen.returncode is not None:
-                    # without this if block
-                    # builds hang
-                    try:
-                        _popen.kill()
-                    except psutil.NoSuchProcess:
-                        pass
-                    break
-        except KeyboardInterrupt:
-            _popen.kill()
-            raise
+    def _sample(self, proc, cgroup, series=None):
+        '''
+        Update the peaks and return (current rss, cpu percent, {process
+        name: rss}); cpu and per-process stats are only collected for a
+        series.
+        '''
+        rss = vms = 0
+        cpu = 0.0
+        procs = defaultdict(int)
+        if cgroup is not None:
+            # One file read covers the whole build
+            rss = cgroup.memory_current()
+            self.rss = max(rss, self.rss or 0)
+            if series is None:
+                return rss, None, None
+        # Sum the build process and everything it spawned; not the
+        # children of this process, which may be running other builds
+        try:
+            children = [proc] + proc.children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        tree_rss = 0
+        # Only the processes alive now are kept for the next sample, so
+        # builds spawning many short-lived compilers do not grow _procs
+        alive = {}
+        for child in children:
+            if series is not None:
+                # cpu_percent is measured since the previous call on the
+                # same Process object
+                cached = self._procs.get(child.pid)
+                if cached is None or cached != child:
+                    cached = child
+                alive[child.pid] = child = cached
+            try:
+                mem = child.memory_info()
+                if series is not None:
+                    cpu += child.cpu_percent(None)
+                    procs[child.name()] += mem.rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                # Exited (or became a zombie) since children() was called
+                continue
+            tree_rss += mem.rss
+            vms += mem.vms
+        if series is not None:
+            self._procs = alive
+        if cgroup is None:
+            rss = tree_rss
+            self.rss = max(rss, self.rss or 0)
+            self.vms = max(vms, self.vms or 0)
+        return rss, cpu, procs
+
+    def _read_cgroup(self, cgroup):
+        try:
+            self.rss = max(cgroup.memory_peak(), self.rss or 0)
+            self.cpu_time = cgroup.cpu_time()
+            self.io_read, self.io_write = cgroup.io_bytes()
+            if cgroup.memory_events().get('oom_kill'):
+                print('Build was OOM killed in', cgroup.path)
+        finally:
+            cgroup.remove()
 
     def __repr__(self):
-        return str({'elapsed': self.elapsed,
-                    'rss': self.rss,
-                    'vms': self.vms,
-                    'returncode': self.returncode})
+        d = {'elapsed': self.elapsed,
+             'rss': self.rss,
+             'vms': self.vms,
+             'returncode': self.returncode}
+        if self.cpu_time is not None:
+            d.update(cpu_time=self.cpu_time, io_read=self.io_read,
+                     io_write=self.io_write)
+        return str(d)
 
 def bytes2human(n):
     # http://code.activestate.com/recipes/578019
@@ -102,6 +286,20 @@ def bytes2human(n):
             return '%.1f%s' % (value, s)
     return "%sB" % n
 
+def human2bytes(s):
+    # Inverse of bytes2human
+    # >>> human2bytes('9.8K')
+    # 10035
+    # >>> human2bytes('1G')
+    # 1073741824
+    symbols = ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
+    s = str(s).strip().upper()
+    if s.endswith('B') and len(s) > 1 and s[-2] in symbols:
+        s = s[:-1]
+    if s and s[-1] in symbols:
+        return int(float(s[:-1]) * (1 << symbols.index(s[-1]) * 10))
+    return int(float(s))
+
 def last_changed_git_branch(git_root):
     args = ['git', 'for-each-ref',
             '--sort=-committerdate', 'refs/heads/',]
@@ -116,22 +314,63 @@ def last_changed_git_branch(git_root):
     print('Last changed branch: ', branch)
     return branch
 
-def git_changed_files(git_rev, git_root=''):
+def iter_git_paths(args, git_root='', chunk_size=1 << 16):
+    '''
+    Run a git command that lists NUL separated paths (e.g. diff-tree -z
+    --name-only) and yield the paths as they are read.  Raises ValueError
+    on a bad return code once the output is consumed.
+    '''
+    proc = subprocess.Popen(args, cwd=git_root or None,
+                            stdout=subprocess.PIPE)
+    rest = b''
+    try:
+        for data in iter(lambda: proc.stdout.read(chunk_size), b''):
+            paths = (rest + data).split(b'\0')
+            rest = paths.pop()
+            for path in paths:
+                if path:
+                    yield path.decode('utf-8', 'replace')
+        if rest:
+            yield rest.decode('utf-8', 'replace')
+    except GeneratorExit:
+        # The caller stopped reading
+        proc.kill()
+        proc.wait()
+        raise
+    proc.stdout.close()
+    if proc.wait():
+        raise ValueError('Bad git return code: {}'.format(proc.poll()))
+
+def git_merge_base(ref, git_rev='HEAD', git_root=''):
+    proc = subprocess.Popen(['git', 'merge-base', ref, git_rev],
+                            cwd=git_root or None, stdout=subprocess.PIPE)
+    out = proc.stdout.read().decode().strip()
+    if proc.wait():
+        raise ValueError('No merge base of {} and {}'.format(ref, git_rev))
+    return out
+
+def git_changed_files(git_rev, git_root='', base=None, recipe_dirs=None):
     """
     Get the list of files changed in a git revision and return a list of package directories that have been modified.
+
+    With base, the files changed between commit base and git_rev are used
+    instead, e.g. base=git_merge_base('origin/master') for a whole PR.
+    Changed paths are mapped to recipe dirs (relative to git_root) with a
+    RecipeIndex of recipe_dirs (default: find_recipe_dirs(git_root)).
     """
-    proc = subprocess.Popen(['git', 'diff-tree',
-                              '--no-commit-id', '--name-only',
-                              '-r', git_rev
-                              ],
-                              cwd=git_root,
-                              stdout=subprocess.PIPE)
-    if proc.wait():
-        raise ValueError('Bad git return code: {}'.format(proc.poll()))
-    files = proc.stdout.read().decode().splitlines()
-    too_short = ('\\','/')
-    changed = {os.path.dirname(f) for f in files}
-    changed = {f for f in changed if f and f not in too_short}
+    args = ['git', 'diff-tree', '-r', '-z', '--name-only', '--relative']
+    if base:
+        args += [base, git_rev]
+    else:
+        args += ['--no-commit-id', '--root', git_rev]
+    if recipe_dirs is None:
+        recipe_dirs = find_recipe_dirs(os.path.abspath(git_root or '.'))
+    index = RecipeIndex(git_root or '.', recipe_dirs)
+    changed = set()
+    for path in iter_git_paths(args, git_root=git_root):
+        rd = index.lookup(path)
+        if rd is not None:
+            changed.add(rd)
     return changed
 
 def read_recipe(path):
@@ -166,18 +405,70 @@ def format_deps(deps):
 def get_build_deps(recipe):
     return format_deps(recipe.get_value('requirements/build'))
 
-def construct_graph(directory, filter_by_git_change=True):
+def render_env_key():
+    '''The things parsed recipe info depends on besides the recipe files'''
+    env_key = [sys.platform, getattr(conda_build, '__version__', None)]
+    return env_key + [os.environ.get(v) for v in RENDER_ENV_VARS]
+
+def directory_key(directory):
+    return hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16]
+
+def recipe_cache_for(directory):
+    '''Return the RecipeCache for a directory of recipes'''
+    return RecipeCache(os.path.join(RECIPE_CACHE_DIR,
+                                    directory_key(directory) + '.json'),
+                       env_key=render_env_key())
+
+def _parse_recipe(recipe_dir):
+    # Runs in a worker process of read_recipe_infos
+    try:
+        pkg = read_recipe(recipe_dir)
+        return recipe_dir, (pkg.name(), describe_meta(pkg)), None
+    except (Exception, SystemExit) as e:
+        # conda-build 1.x calls sys.exit on bad recipes, which would end
+        # a pool worker (and hang the pool) or the whole run
+        return recipe_dir, None, repr(e)
+
+def read_recipe_infos(recipe_dirs, cache=None, processes=None):
     '''
-    Construct a directed graph of dependencies from a directory of recipes
+    Return ({recipe_dir: (name, meta)}, {recipe_dir: error}) for recipe_dirs.
 
-    Annotate dependencies that don't have recipes in that directory
+    Recipes not in cache are parsed in a pool of processes
+    (default: one per cpu, at most one per recipe).
     '''
-    print('construct_graph with args: ', directory, filter_by_git_change)
-    g = nx.DiGraph()
-    build_numbers = {}
-    directory = os.path.abspath(directory)
-    assert os.path.isdir(directory)
+    infos, errors, todo = {}, {}, []
+    for recipe_dir in recipe_dirs:
+        info = cache.get(recipe_dir) if cache is not None else None
+        if info is None:
+            todo.append(recipe_dir)
+        else:
+            infos[recipe_dir] = tuple(info)
+    if len(todo) > 1 and processes != 1:
+        # No more workers than recipes to parse
+        processes = min(processes or multiprocessing.cpu_count(), len(todo))
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunksize = max(1, len(todo) // (4 * processes))
+            results = list(pool.imap_unordered(_parse_recipe, todo, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_parse_recipe(recipe_dir) for recipe_dir in todo]
+    for recipe_dir, info, error in results:
+        if error is not None:
+            errors[recipe_dir] = error
+            continue
+        infos[recipe_dir] = info
+        if cache is not None:
+            cache.put(recipe_dir, *info)
+    return infos, errors
 
+def find_recipe_dirs(directory):
+    '''
+    Return the set of recipe dirs (relative to directory): subdirectories
+    with a meta.yaml, one or two levels down.
+    '''
     # get all immediate subdirectories
     other_top_dirs = [d for d in os.listdir(directory)
                     if os.path.isdir(os.path.join(directory, d)) and
@@ -187,17 +478,160 @@ def construct_graph(directory, filter_by_git_change=True):
     for top in other_top_dirs:
         next_level = next(os.walk(os.path.join(directory, top)))[1]
         recipe_dirs += [os.path.join(top, n) for n in next_level]
-    recipe_dirs = set(x for x in recipe_dirs if not x.startswith('.'))
+    return set(x for x in recipe_dirs if not x.startswith('.') and
+               os.path.exists(os.path.join(directory, x, 'meta.yaml')))
+
+class RecipeIndex(object):
+    '''
+    Map paths (relative to directory, '/' separated as git prints them)
+    to the recipe dir containing them, for flat (pkg/) and nested
+    (top/pkg/) layouts.
+
+    Lookups are dict lookups of the path's first one or two components
+    in recipe_dirs.  Components not in recipe_dirs are checked for a
+    meta.yaml on disk, which finds recipes added since the index was made.
+    '''
+
+    def __init__(self, directory, recipe_dirs=()):
+        self.directory = directory
+        self.dirs = {}
+        for rd in recipe_dirs:
+            self.add(rd)
+
+    def add(self, rd):
+        self.dirs[rd.replace(os.sep, '/')] = rd
+
+    def lookup(self, path):
+        parts = path.split('/')
+        for n in (1, 2):
+            if n >= len(parts):
+                break
+            candidate = '/'.join(parts[:n])
+            if candidate in self.dirs:
+                return self.dirs[candidate]
+            rd = os.path.join(*parts[:n])
+            if os.path.exists(os.path.join(self.directory, rd, 'meta.yaml')):
+                self.add(rd)
+                return rd
+        return None
+
+def recipe_dirs_for_paths(paths, directory, known=()):
+    '''
+    Return the recipe dirs (relative to directory) that contain any of
+    paths (also relative to directory).  A recipe dir in known counts
+    even if it no longer exists (it was deleted).
+    '''
+    index = RecipeIndex(directory, known)
+    found = (index.lookup(path) for path in paths)
+    return set(rd for rd in found if rd is not None)
+
+def git_head(git_root):
+    proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                            cwd=git_root, stdout=subprocess.PIPE)
+    out = proc.stdout.read().decode().strip()
+    if proc.wait():
+        raise ValueError('Bad git return code: {}'.format(proc.poll()))
+    return out
+
+def snapshot_recipe_infos(directory, cache=None, processes=None):
+    '''
+    Return ({recipe dir: (name, meta)}, {recipe dir: error}) like
+    read_recipe_infos, but starting from the snapshot saved in
+    GRAPH_SNAPSHOT_DIR by the last run: only recipes changed between
+    the snapshot's commit and HEAD are read again.
+
+    The snapshot follows commits, so uncommitted changes to recipes are
+    not seen.
+    '''
+    snapshot = GraphSnapshot(os.path.join(GRAPH_SNAPSHOT_DIR,
+                                          directory_key(directory) + '.json'),
+                             env_key=render_env_key())
+    head = git_head(directory)
+    changed = None
+    if snapshot.commit == head:
+        changed = set()
+    elif snapshot.commit:
+        args = ['git', 'diff-tree', '-r', '-z', '--name-only', '--relative',
+                snapshot.commit, head]
+        known = set(snapshot.recipes) | set(snapshot.errors)
+        try:
+            changed = recipe_dirs_for_paths(iter_git_paths(args, directory),
+                                            directory, known=known)
+        except ValueError:
+            # e.g. the snapshot's commit is gone after a force push
+            changed = None
+    if changed is None:
+        print('No usable graph snapshot, reading all recipes')
+        snapshot.recipes, snapshot.errors = {}, {}
+        changed = find_recipe_dirs(directory)
+    else:
+        print('Graph snapshot at {}: {} recipes changed'.format(
+              snapshot.commit[:10], len(changed)))
+    for rd in changed:
+        snapshot.recipes.pop(rd, None)
+        snapshot.errors.pop(rd, None)
+    existing = [rd for rd in changed
+                if os.path.exists(os.path.join(directory, rd, 'meta.yaml'))]
+    infos, errors = read_recipe_infos([os.path.join(directory, rd)
+                                       for rd in existing],
+                                      cache=cache, processes=processes)
+    for rd in existing:
+        recipe_dir = os.path.join(directory, rd)
+        if recipe_dir in infos:
+            snapshot.recipes[rd] = infos[recipe_dir]
+        else:
+            snapshot.errors[rd] = errors[recipe_dir]
+    if changed or snapshot.commit != head:
+        snapshot.save(head)
+    return ({os.path.join(directory, rd): info
+             for rd, info in snapshot.recipes.items()},
+            {os.path.join(directory, rd): error
+             for rd, error in snapshot.errors.items()})
+
+def construct_graph(directory, filter_by_git_change=True, use_cache=True,
+                    processes=None, incremental=False, git_base=None):
+    '''
+    Construct a directed graph of dependencies from a directory of recipes
+
+    Annotate dependencies that don't have recipes in that directory
+
+    With use_cache, parsed recipe info is kept in RECIPE_CACHE_DIR and
+    only recipes whose files changed are parsed again.  Those are parsed
+    by a pool of processes (see read_recipe_infos).  Recipes that fail to
+    parse are printed and left in g.graph['parse_errors'].
+
+    With incremental (directory must be a git checkout), the recipe dirs
+    are not even listed: the graph is updated from a snapshot of the last
+    run with the recipes git says changed since (see snapshot_recipe_infos).
+
+    With filter_by_git_change, only recipes changed in HEAD are marked
+    dirty, or those changed between git_base and HEAD if git_base is given.
+    '''
+    print('construct_graph with args: ', directory, filter_by_git_change)
+    g = nx.DiGraph()
+    directory = os.path.abspath(directory)
+    assert os.path.isdir(directory)
+
+    cache = recipe_cache_for(directory) if use_cache else None
+    if incremental:
+        infos, errors = snapshot_recipe_infos(directory, cache=cache,
+                                              processes=processes)
+    else:
+        recipe_dirs = find_recipe_dirs(directory)
+        infos, errors = read_recipe_infos([os.path.join(directory, rd)
+                                           for rd in recipe_dirs],
+                                          cache=cache, processes=processes)
+    for recipe_dir, error in sorted(errors.items()):
+        print('Failed to parse recipe {}: {}'.format(recipe_dir, error))
+    g.graph['parse_errors'] = errors
     if filter_by_git_change:
-        changed_recipes = git_changed_files('HEAD', git_root=directory)
+        known = [os.path.relpath(rd, directory) for rd in infos]
+        changed_recipes = git_changed_files('HEAD', git_root=directory,
+                                            base=git_base, recipe_dirs=known)
         print('changed_recipes {}'.format(changed_recipes))
-    for rd in recipe_dirs:
-        recipe_dir = os.path.join(directory, rd)
-        try:
-            pkg = read_recipe(recipe_dir)
-            name = pkg.name()
-        except:
-            continue
+    for recipe_dir in sorted(infos):
+        rd = os.path.relpath(recipe_dir, directory)
+        name, meta = infos[recipe_dir]
 
         # add package (in case it has no build deps)
         if filter_by_git_change:
@@ -206,25 +640,51 @@ def construct_graph(directory, filter_by_git_change=True):
                 _dirty = True
         else:
             _dirty = True
-        g.add_node(name, meta=describe_meta(pkg), recipe=recipe_dir, dirty=_dirty)
-        for k, d in get_build_deps(pkg).items():
+        g.add_node(name, meta=meta, recipe=recipe_dir, dirty=_dirty)
+        for k, d in meta['depends'].items():
             g.add_edge(name, k)
+    if cache is not None:
+        print('Recipe cache: {} parsed, {} reused'.format(cache.misses, cache.hits))
+        # An incremental run only looks at changed recipes
+        cache.save(prune=not incremental)
     return g
 
-def dirty(graph, implicit=True):
+def invalidate(graph, changed, depth=None):
+    """
+    Return {node: distance} of the nodes in changed and every package
+    that build-depends on them, directly or not, up to depth steps away
+    (all of them with depth=None).  distance is the number of steps
+    from the nearest changed node.
+
+    A breadth first search over predecessors: O(V + E) for any depth.
+    The graph is not modified.
+    """
+    distance = {n: 0 for n in changed if graph.has_node(n)}
+    frontier = deque(distance)
+    while frontier:
+        node = frontier.popleft()
+        step = distance[node] + 1
+        if depth is not None and step > depth:
+            continue
+        for pred in graph.predecessors_iter(node):
+            if pred not in distance:
+                distance[pred] = step
+                frontier.append(pred)
+    return distance
+
+def dirty(graph, implicit=True, depth=1):
     """
     Return a set of all dirty nodes in the graph.
 
-    These include implicit and explicit dirty nodes.
+    These include implicit and explicit dirty nodes.  Implicit ones
+    depend on an explicit one at most depth steps away (see invalidate).
     """
-    # Reverse the edges to get true dependency
     dirty_nodes = {n for n, v in graph.node.items() if v.get('dirty', False)}
     if not implicit:
         return dirty_nodes
 
     # Get implicitly dirty nodes (all of the packages that depend on a dirty package)
-    dirty_nodes.update(*map(set, (graph.predecessors(n) for n in dirty_nodes)))
-    return dirty_nodes
+    return set(invalidate(graph, dirty_nodes, depth=depth))
 
 def build_order(graph, packages, level=0, filter_by_git_change=True):
     '''
@@ -269,61 +729,230 @@ def build_order(graph, packages, level=0, filter_by_git_change=True):
 
 def make_deps(graph, package, dry=False, extra_args='',
               level=0, autofail=True, jobtimeout=3600,
-              timeoutbuffer=600):
+              timeoutbuffer=600, jobs=1, profile=None,
+              max_mem=None, max_disk=None, cgroup=None,
+              build_mem_limit=None, build_cpu_limit=None,
+              build_cache=True, critical_path=False,
+              checkpoint=None, resume=False, report=None, prom=None,
+              timeline=None, log_dir=None, pkgs_dir=None,
+              local_channel=None):
+    '''
+    Build package (see build_order) and everything it needs, returning
+    lists of succeeded, failed and not tested packages and a dict of
+    package: PopenWrapper.
+
+    With build_cache, packages whose recipe and dependency closure are
+    unchanged since a successful build (recorded in CONDA_BUILD_CACHE)
+    are not built again.
+
+    With critical_path, packages holding up the longest chains of
+    predicted build time (from profile) are started first.
+
+    With checkpoint (a file name), finished packages are journaled as
+    they finish (see protoci.checkpoint).  With resume, packages an
+    earlier run with the same checkpoint finished (failed ones included)
+    are not built again, so a long build can be split over several
+    time limited jobs.
+
+    report (a .csv or json lines file name) and prom (a Prometheus
+    textfile) get per-package stats of the run (see protoci.report).
+    timeline (a file name) gets resource samples over time of every build
+    (see protoci.timeline).  With log_dir, each build's output goes to
+    its own file there (see make_pkg).
+
+    pkgs_dir is the package cache of the builds (default: conda's own).
+
+    With local_channel (a directory), every package built (or found in
+    the build cache) is added to a channel there as soon as it is done,
+    and builds use that channel, so downstream builds install the
+    upstream packages of this run (see protoci.channel).
+    '''
     g, order = build_order(graph, package, level=level)
     # Filter out any packages that don't have recipes
     order = [pkg for pkg in order if g.node[pkg].get('meta')]
+    # Dry runs would record echo stats, so they get no profile
+    resources = None if dry else ResourceProfile(profile or RESOURCE_PROFILE)
+    if critical_path:
+        predict = resources or ResourceProfile(profile or RESOURCE_PROFILE)
+        order = critical_path_order(g, order,
+                                    lambda pkg: predict.predict(pkg)['elapsed'] or 1)
     print("Build order:\n{}".format('\n'.join(order)))
-    elapsed = 0.0
-    failed = set()
-    not_tested = set()
-    build_times = {x:None for x in order}
-    for pkg in order:
-        print("Building ", pkg)
+
+    names = {g.node[pkg]['recipe']: pkg for pkg in order}
+    store = keys = None
+    if build_cache and not dry:
+        store = BuildStore(CONDA_BUILD_CACHE)
+        salt = json.dumps([sys.platform, extra_args] +
+                          [os.environ.get(v) for v in RENDER_ENV_VARS])
+        keys = build_keys(graph, order, salt=salt)
+
+    journal = finished = on_finish = None
+    if checkpoint:
+        journal = Checkpoint(checkpoint, resume=resume)
+        finished = journal.finished(order, keys=keys)
+        journal.start(order)
+
+        def on_finish(pkg, result, failed):
+            journal.record(pkg, result, failed,
+                           key=keys[pkg] if keys is not None else None)
+    elif resume:
+        raise ValueError('resume needs a checkpoint file')
+
+    cgroup_parent = None
+    if cgroup and not dry:
+        cgroup_parent = build_cgroup.prepare_parent(cgroup)
+        print('Building in cgroups under', cgroup_parent)
+
+    samples = Timeline(timeline) if timeline and not dry else None
+    channel = None
+    build_args = extra_args
+    if local_channel and not dry:
+        channel = LocalChannel(local_channel)
+        # Left out of the build cache salt, whose keys already cover the
+        # packages built in this run
+        build_args = '{} -c {}'.format(extra_args, channel.url).strip()
+
+    def add_to_channel(path):
         try:
-            # Autofail package if any dependency build failed
-            if any(p in failed for p in order):
-                print(failed)
-                failed_deps = [p for p in g.node[pkg]['meta']['depends'].keys() if p in failed]
-                print("Building {} failed because one or more of its dependencies failed to build: ".format(pkg), end=' ')
-                print(', '.join(failed_deps))
-                failed.add(pkg)
-                continue
-            build_time = make_pkg(g.node[pkg], dry=dry, extra_args=extra_args)
-
-            build_times[pkg] = build_time
-            if build_time is None:
-                failed.add(pkg)
-            elapsed += build_times[pkg].elapsed
-            if elapsed > jobtimeout - timeoutbuffer:
-                idx = order.index(pkg) + 1
-                if idx >= len(order):
-                    not_tested = set()
-                else:
-                    not_tested = set(order[idx:])
-                print('TIMEOUT within protoci, NOT_TESTED', not_tested)
-                break
-            if build_times[pkg].returncode:
-                failed.add(pkg)
-        except KeyboardInterrupt:
-            print('KeyboardInterrupt')
-            break
-        except subprocess.CalledProcessError:
-            failed.add(pkg)
-            continue
+            channel.add(path)
+        except Exception as e:
+            print('Could not add', path, 'to the local channel:', repr(e))
+
+    def build_fn(node):
+        if store is not None:
+            key = keys[names[node['recipe']]]
+            cached = store.get(key)
+            if cached is not None:
+                print('Skipping {}: unchanged since build of {} ({})'.format(
+                      node['recipe'], cached.built, cached.output))
+                if channel is not None and cached.output:
+                    add_to_channel(cached.output)
+                return cached
+        series = Series() if samples is not None else None
+        result = make_pkg(node, dry=dry, extra_args=build_args,
+                          cgroup_parent=cgroup_parent,
+                          mem_limit=build_mem_limit,
+                          cpu_limit=build_cpu_limit,
+                          series=series,
+                          log_dir=log_dir,
+                          env=pkgs_environ(pkgs_dir) if pkgs_dir else None)
+        if (channel is not None and result is not None and not result.returncode
+                and result.output and os.path.exists(result.output)):
+            add_to_channel(result.output)
+        if samples is not None:
+            samples.add(names[node['recipe']], series, result)
+        if store is not None:
+            store.put(key, names[node['recipe']], result)
+        return result
+
+    scheduler = BuildScheduler(g, order, build_fn, jobs=jobs,
+                               autofail=autofail,
+                               jobtimeout=jobtimeout,
+                               timeoutbuffer=timeoutbuffer,
+                               profile=resources,
+                               max_mem=max_mem,
+                               max_disk=max_disk,
+                               finished=finished,
+                               on_finish=on_finish)
+    try:
+        result = scheduler.run()
+    finally:
+        if resources is not None:
+            resources.save()
+        if samples is not None:
+            samples.close()
+    if journal is not None:
+        journal.close(result[2])
+    if report or prom:
+        records = build_report.build_records(result[3], result[0], result[1],
+                                             result[2], scheduler.timings)
+        if report:
+            build_report.write_report(report, records)
+        if prom:
+            build_report.write_prom(prom, records)
+    return result
+
 
-    return list(set(order) - failed - not_tested), list(failed), list(not_tested), build_times
+def conda_build_config():
+    try:
+        # conda-build 1.x
+        from conda_build.config import config
+    except ImportError:
+        from conda_build.config import Config
+        config = Config()
+    return config
 
+def conda_build_output(path, extra_args=(), env=None):
+    '''Return the package file conda build makes from recipe path, or None'''
+    args = ['conda', 'build', '--output'] + list(extra_args) + [path]
+    try:
+        out = subprocess.check_output(args, env=env).decode().strip().splitlines()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return out[-1] if out else None
 
-def make_pkg(package, dry=False, extra_args=''):
+def make_pkg(package, dry=False, extra_args='', cgroup_parent=None,
+             mem_limit=None, cpu_limit=None, series=None, log_dir=None,
+             env=None):
+    '''
+    Build the package (a node of construct_graph's graph) with conda build.
+
+    If cgroup_parent (see protoci.cgroup.prepare_parent) is given, the
+    build runs in its own cgroup with optional mem_limit (bytes) and
+    cpu_limit (cpus), which also gives exact peak memory, cpu and io stats.
+
+    series (a protoci.timeline.Series) gets the resource samples taken
+    during the build.
+
+    With log_dir, the build's output goes to log_dir/<recipe>.log instead
+    of stdout, and its last lines are printed if it fails.  env is the
+    environment of conda build (default: this process's).
+
+    The build runs in a conda-bld root of its own (see protoci.buildroot),
+    so builds can run at the same time; the package made is moved to the
+    croot of env, which is indexed and given to every build as a channel.
+    '''
     meta, path = package['meta'], package['recipe']
     print("===========> Building ", path)
     if not dry:
         try:
             extra_args = extra_args.split()
+            cgroup = None
+            if cgroup_parent:
+                cgroup = build_cgroup.BuildCgroup(cgroup_parent,
+                                                  os.path.basename(path),
+                                                  mem_limit=mem_limit,
+                                                  cpu_limit=cpu_limit)
+            config = conda_build_config()
+            name = os.path.basename(path)
+            log_file = None
+            if log_dir:
+                if not os.path.isdir(log_dir):
+                    os.makedirs(log_dir)
+                log_file = os.path.join(log_dir, name + '.log')
+            croot = (env or os.environ).get('CONDA_BLD_PATH') or config.croot
+            root = BuildRoot(croot, name)
+            # Packages built before this one are in the shared croot
+            extra_args = extra_args + ['-c', root.channel.url]
             args = ['conda', 'build', '-q'] + extra_args + [path]
             print("+ " + ' '.join(args))
-            p = PopenWrapper(args, time_int=1)
+            # Everything in the root is this build's (the links to the
+            # source caches are not followed), its package included
+            disk = DiskTracker([root.root])
+            try:
+                build_env = root.environ(env)
+                p = PopenWrapper(args, time_int=1, cgroup=cgroup, disk=disk,
+                                 series=series, log_file=log_file,
+                                 heartbeat=HEARTBEAT, name=name, env=build_env)
+                if p.returncode and p.tail:
+                    print('{} failed with returncode {}, last {} lines of {}:\n{}'.format(
+                          name, p.returncode, len(p.tail), log_file,
+                          b''.join(p.tail).decode('utf-8', 'replace')))
+                output = conda_build_output(path, extra_args, env=build_env)
+                # Nothing of a failed build goes to the shared croot
+                p.output = root.collect(output) if output and not p.returncode else None
+            finally:
+                root.remove()
             return p
         except subprocess.CalledProcessError as e:
             print("Build failed with errorcode: ", e.returncode)
@@ -371,6 +1000,23 @@ def build_cli(parse_this=None):
     parser.add_argument("-args", action='store', dest='cbargs', default='')
     parser.add_argument("-l", type=int, action='store', dest='level', default=0)
     parser.add_argument("-noautofail", action='store_false', dest='autofail', default=True)
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help="Number of packages to build at once. Packages are "
+                             "started as soon as their build deps have finished.")
+    parser.add_argument('-max-mem',
+                        type=human2bytes,
+                        help="Memory budget for concurrent builds, e.g. 24G. "
+                             "Uses peak RSS recorded in -profile.")
+    parser.add_argument('-max-disk',
+                        type=human2bytes,
+                        help="Disk budget for concurrent builds, e.g. 50G. "
+                             "Uses peak disk usage recorded in -profile.")
+    parser.add_argument('-profile',
+                        default=RESOURCE_PROFILE,
+                        help="Json file of per-package build resource history. "
+                             "Default: %(default)s")
     parser.add_argument('--targetnum', '-t',
                         type=int,
                         help="Target number of packages in each subtree-build.")
@@ -382,6 +1028,53 @@ def build_cli(parse_this=None):
                         required=False,
                         type=int,
                         help="Used only in git diff (depth of changed packages)")
+    parser.add_argument('-cgroup',
+                        help="Run each build in its own cgroup (v2) under this "
+                             "delegated cgroup, or 'auto' for the current one. "
+                             "Gives exact peak memory, cpu and io per build.")
+    parser.add_argument('-build-mem-limit',
+                        type=human2bytes,
+                        help="memory.max of each build's cgroup, e.g. 8G")
+    parser.add_argument('-build-cpu-limit',
+                        type=float,
+                        help="Number of cpus of each build's cgroup, e.g. 2")
+    parser.add_argument('-no-build-cache',
+                        action='store_false',
+                        dest='build_cache',
+                        help="Rebuild packages even if an identical build "
+                             "succeeded before (see {}).".format(CONDA_BUILD_CACHE))
+    parser.add_argument('-critical-path',
+                        action='store_true',
+                        help="Start ready packages with the longest chain of "
+                             "dependents (by -profile build times) first.")
+    parser.add_argument('-checkpoint',
+                        help="Json lines file to which each finished build is "
+                             "appended, for -resume.")
+    parser.add_argument('-resume',
+                        action='store_true',
+                        help="Skip the packages -checkpoint records as finished "
+                             "by an earlier run of the same build.")
+    parser.add_argument('-report',
+                        help="Write a per-package build report to this file "
+                             "(csv if it ends with .csv, otherwise json lines).")
+    parser.add_argument('-prom',
+                        help="Write per-package build metrics in the Prometheus "
+                             "text format to this file.")
+    parser.add_argument('-timeline',
+                        help="Write the resource samples of every build to this "
+                             "file (see protoci-timeline).")
+    parser.add_argument('-log-dir',
+                        default=None,
+                        help="Write the output of each build to <package>.log "
+                             "in this directory. Default with -j > 1: "
+                             "./protoci-logs")
+    parser.add_argument('-pkgs-dir',
+                        help="Package cache (CONDA_PKGS_DIRS) of the builds. "
+                             "Default: conda's own.")
+    parser.add_argument('-local-channel',
+                        help="Directory of a conda channel to which each package "
+                             "is added as soon as it is built, and which the "
+                             "builds use.")
     if parse_this is None:
         args = parser.parse_args()
     else:
@@ -389,6 +1082,11 @@ def build_cli(parse_this=None):
     if not args.build:
         args.build = None
     print('Running build2.py with args of', args)
+    if args.log_dir is None and args.jobs > 1:
+        # Output of concurrent builds would interleave
+        args.log_dir = os.path.join('.', 'protoci-logs')
+    if args.resume and not args.checkpoint:
+        parser.error('-resume needs -checkpoint')
     if getattr(args, 'json_file_key', None):
         assert len(args.json_file_key) == 2, 'Should be 2 args: json_filename key'
     return args
@@ -0,0 +1,117 @@
+from __future__ import print_function, division
+
+import datetime
+import hashlib
+import json
+import os
+
+from protoci.recipe_cache import recipe_hash
+
+STATS = ('elapsed', 'rss', 'vms', 'disk', 'cpu_time', 'io_read', 'io_write')
+
+
+def build_keys(graph, packages, salt=''):
+    '''
+    Return {package: key} for packages (nodes of graph).
+
+    The key of a package is a sha1 over its recipe files, salt (build
+    arguments and environment) and the keys of its build deps, so it
+    changes when anything in its dependency closure changes.  Deps
+    without a recipe in graph contribute their version spec, and so do
+    deps closing a cycle of build deps.  The graph is walked without
+    recursion, so deep trees cannot overflow the stack.
+    '''
+    keys = {}
+
+    def recipe_deps(pkg):
+        depends = graph.node[pkg]['meta']['depends']
+        return [dep for dep in sorted(depends) if dep != pkg and
+                graph.has_node(dep) and graph.node[dep].get('meta')]
+
+    def digest(pkg):
+        h = hashlib.sha1(salt.encode('utf-8'))
+        node = graph.node[pkg]
+        h.update(recipe_hash(node['recipe']).encode('utf-8'))
+        depends = node['meta']['depends']
+        for dep in sorted(depends):
+            # Not keyed: no recipe, or still in progress (a cycle)
+            dep_key = keys.get(dep) if dep != pkg else None
+            if dep_key is None:
+                dep_key = 'spec:' + depends[dep]
+            h.update('{}={};'.format(dep, dep_key).encode('utf-8'))
+        return h.hexdigest()
+
+    for start in packages:
+        if start in keys:
+            continue
+        in_progress = set([start])
+        stack = [(start, iter(recipe_deps(start)))]
+        while stack:
+            pkg, deps = stack[-1]
+            for dep in deps:
+                if dep not in keys and dep not in in_progress:
+                    in_progress.add(dep)
+                    stack.append((dep, iter(recipe_deps(dep))))
+                    break
+            else:
+                stack.pop()
+                in_progress.discard(pkg)
+                keys[pkg] = digest(pkg)
+    return {pkg: keys[pkg] for pkg in packages}
+
+
+class CachedResult(object):
+    '''Stands in for the PopenWrapper of a build skipped by the store'''
+
+    cached = True
+    returncode = 0
+
+    def __init__(self, entry):
+        self.output = entry.get('output')
+        self.built = entry.get('built')
+        for k in STATS:
+            setattr(self, k, entry.get('stats', {}).get(k))
+
+    def __repr__(self):
+        return str({'cached': True, 'built': self.built,
+                    'output': self.output})
+
+
+class BuildStore(object):
+    '''
+    Directory of json records of successful builds, one file per build key,
+    holding the output package path and the build's PopenWrapper stats.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        '''Return a CachedResult for key, or None when it must be built'''
+        try:
+            with open(self._file(key), 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        output = entry.get('output')
+        if output and not os.path.exists(output):
+            # The package was cleaned out of conda-bld
+            return None
+        return CachedResult(entry)
+
+    def put(self, key, package, result):
+        if result is None or result.returncode:
+            return
+        entry = {'package': package,
+                 'output': getattr(result, 'output', None),
+                 'built': datetime.datetime.now().isoformat(),
+                 'stats': {k: getattr(result, k, None) for k in STATS}}
+        tmp = self._file(key) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f, indent=1, sort_keys=True)
+        getattr(os, 'replace', os.rename)(tmp, self._file(key))
@@ -0,0 +1,133 @@
+"""
+A conda-bld root of its own for every build.
+
+conda-build 1.x builds in fixed directories: work/ and the package
+output under its croot, and the _build and _test prefixes under the
+first conda envs dir.  Builds running at the same time (make_deps with
+jobs > 1, or several sequential builds on one machine) would clobber
+each other there, so each build gets a root of its own: CONDA_BLD_PATH
+and CONDA_ENVS_PATH point into it, the source caches of the shared croot
+are linked in, and the package made is moved to the shared croot once
+the build is done.
+
+conda build only uses its own croot as a channel, so the shared croot is
+indexed as each package arrives (see protoci.channel) and builds get it
+with -c, to find the packages built before them.
+"""
+from __future__ import print_function, division
+
+import os
+import shutil
+import tempfile
+import threading
+
+from protoci.channel import LocalChannel
+
+# Directories of the shared croot every build uses
+SOURCE_CACHES = ('src_cache', 'git_cache', 'hg_cache', 'svn_cache')
+# Directory next to the shared croot the build roots go in by default,
+# so work dirs stay on the disk conda-bld is on
+ROOTS_DIR = 'protoci-builds'
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def croot_channel(croot):
+    '''The LocalChannel of croot, one per croot for all builds at once'''
+    croot = os.path.abspath(croot)
+    with _channels_lock:
+        if croot not in _channels:
+            _channels[croot] = LocalChannel(croot)
+        return _channels[croot]
+
+
+def pkgs_environ(pkgs_dir, env=None):
+    '''env (default os.environ) using pkgs_dir, if given, as package cache'''
+    env = dict(os.environ if env is None else env)
+    if pkgs_dir:
+        env['CONDA_PKGS_DIRS'] = os.path.abspath(pkgs_dir)
+    return env
+
+
+def conda_pkgs_dir():
+    '''The first package cache of conda, or None if conda is not importable'''
+    try:
+        # conda >= 4.3
+        from conda.base.context import context
+        dirs = context.pkgs_dirs
+    except ImportError:
+        try:
+            from conda.config import pkgs_dirs as dirs
+        except ImportError:
+            return None
+    return list(dirs)[0] if dirs else None
+
+
+class BuildRoot(object):
+    '''
+    Temporary root (in base, default ROOTS_DIR next to croot) for one
+    build named name, whose packages end up in croot.
+    '''
+
+    def __init__(self, croot, name, base=None):
+        self.croot = os.path.abspath(croot)
+        self.channel = croot_channel(self.croot)
+        if base is None:
+            base = os.path.join(os.path.dirname(self.croot), ROOTS_DIR)
+        if not os.path.isdir(base):
+            os.makedirs(base)
+        self.root = tempfile.mkdtemp(prefix=name + '-', dir=base)
+        self.bld = os.path.join(self.root, 'conda-bld')
+        self.envs = os.path.join(self.root, 'envs')
+        os.makedirs(self.bld)
+        os.makedirs(self.envs)
+        for cache in SOURCE_CACHES:
+            shared = os.path.join(self.croot, cache)
+            try:
+                if not os.path.isdir(shared):
+                    os.makedirs(shared)
+                os.symlink(shared, os.path.join(self.bld, cache))
+            except (OSError, AttributeError, NotImplementedError):
+                # No symlinks (Windows): sources are fetched per build
+                pass
+
+    def environ(self, env=None):
+        '''env (default os.environ) building in this root'''
+        env = dict(os.environ if env is None else env)
+        if not env.get('CONDA_PKGS_DIRS'):
+            # Older conda would use a package cache next to the envs dir
+            pkgs_dir = conda_pkgs_dir()
+            if pkgs_dir:
+                env['CONDA_PKGS_DIRS'] = pkgs_dir
+        env['CONDA_BLD_PATH'] = self.bld
+        env['CONDA_ENVS_PATH'] = self.envs
+        return env
+
+    def collect(self, path):
+        '''
+        Move the package at path (made in this root) to the same place
+        in the shared croot and add it to the croot's channel.  Returns
+        the new path, or None if the build made no package.
+        '''
+        if not os.path.exists(path):
+            return None
+        rel = os.path.relpath(os.path.abspath(path), self.bld)
+        if rel.startswith(os.pardir):
+            return path
+        target = os.path.join(self.croot, rel)
+        parent = os.path.dirname(target)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.exists(target):
+            os.remove(target)
+        shutil.move(path, target)
+        try:
+            self.channel.add(target)
+        except Exception as e:
+            print('Could not index', target, 'in', self.croot + ':', repr(e))
+        return target
+
+    def remove(self):
+        # Links to the source caches are removed, not followed
+        shutil.rmtree(self.root, ignore_errors=True)
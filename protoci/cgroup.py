@@ -0,0 +1,168 @@
+"""
+cgroup v2 accounting and limits for single builds (Linux only).
+
+Builds are placed in child cgroups of a delegated cgroup the build user
+can write to, e.g. one made with:
+
+systemd-run --user --scope -p Delegate=yes protoci-sequential-build ... -cgroup auto
+
+or any directory under /sys/fs/cgroup chown'd to the build user.
+"""
+from __future__ import print_function, division
+import errno
+import itertools
+import os
+import time
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CONTROLLERS = ('memory', 'cpu', 'io')
+# Shell prefix that moves itself into a cgroup and then becomes the build,
+# so every process of the build starts inside the cgroup.
+ENTER = 'echo $$ > "$0" && exec "$@"'
+
+_counter = itertools.count()
+
+
+def _read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+
+def available():
+    return os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers'))
+
+
+def current_cgroup():
+    '''Return the cgroup v2 directory of this process'''
+    for line in _read('/proc/self/cgroup').splitlines():
+        if line.startswith('0::'):
+            return os.path.join(CGROUP_ROOT, line[3:].strip().lstrip('/'))
+    raise ValueError('Not running under a cgroup v2 hierarchy')
+
+
+def prepare_parent(parent):
+    '''
+    Make parent able to hold build cgroups: cgroup v2 does not allow
+    processes in a cgroup that hands controllers to its children, so any
+    processes in parent (normally just this one) move to parent/supervisor
+    before the memory, cpu and io controllers are enabled for children.
+    '''
+    if parent == 'auto':
+        parent = current_cgroup()
+    procs = _read(os.path.join(parent, 'cgroup.procs')).split()
+    if procs:
+        supervisor = os.path.join(parent, 'supervisor')
+        if not os.path.isdir(supervisor):
+            os.mkdir(supervisor)
+        for pid in procs:
+            try:
+                _write(os.path.join(supervisor, 'cgroup.procs'), pid)
+            except (IOError, OSError) as e:
+                # Exited already
+                if e.errno != errno.ESRCH:
+                    raise
+    controllers = _read(os.path.join(parent, 'cgroup.controllers')).split()
+    if 'memory' not in controllers:
+        raise ValueError('The memory controller is not delegated to ' + parent)
+    wanted = ' '.join('+' + c for c in CONTROLLERS if c in controllers)
+    if wanted:
+        _write(os.path.join(parent, 'cgroup.subtree_control'), wanted)
+    return parent
+
+
+class BuildCgroup(object):
+    '''
+    A cgroup for one build under parent (see prepare_parent).
+
+    mem_limit (bytes) is written to memory.max and cpu_limit (number of
+    cpus, may be fractional) to cpu.max.  After the build, peak memory,
+    cpu time and io bytes are read from the cgroup files, which count
+    every process of the build, including short lived ones.
+    '''
+
+    def __init__(self, parent, name, mem_limit=None, cpu_limit=None):
+        safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        self.path = os.path.join(parent, 'protoci-{}-{}-{}'.format(
+                                 safe, os.getpid(), next(_counter)))
+        os.mkdir(self.path)
+        self.peak_seen = 0
+        if mem_limit:
+            _write(self.file('memory.max'), int(mem_limit))
+        if cpu_limit:
+            period = 100000
+            _write(self.file('cpu.max'), '{} {}'.format(int(cpu_limit * period), period))
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def wrap(self, args):
+        '''Return args as a command that runs inside this cgroup'''
+        if isinstance(args, str):
+            args = ['sh', '-c', args]
+        return ['sh', '-c', ENTER, self.file('cgroup.procs')] + list(args)
+
+    def memory_current(self):
+        current = int(_read(self.file('memory.current')))
+        self.peak_seen = max(self.peak_seen, current)
+        return current
+
+    def memory_peak(self):
+        # memory.peak needs Linux 5.19, otherwise use the sampled peak
+        try:
+            return max(int(_read(self.file('memory.peak'))), self.peak_seen)
+        except (IOError, OSError):
+            return self.peak_seen
+
+    def cpu_time(self):
+        '''user + system cpu seconds'''
+        for line in _read(self.file('cpu.stat')).splitlines():
+            key, value = line.split()
+            if key == 'usage_usec':
+                return int(value) / 1e6
+
+    def io_bytes(self):
+        '''(read bytes, written bytes) over all devices'''
+        rbytes = wbytes = 0
+        try:
+            stat = _read(self.file('io.stat'))
+        except (IOError, OSError):
+            return None, None
+        for line in stat.splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition('=')
+                if key == 'rbytes':
+                    rbytes += int(value)
+                elif key == 'wbytes':
+                    wbytes += int(value)
+        return rbytes, wbytes
+
+    def memory_events(self):
+        events = {}
+        try:
+            lines = _read(self.file('memory.events')).splitlines()
+        except (IOError, OSError):
+            return events
+        for line in lines:
+            key, value = line.split()
+            events[key] = int(value)
+        return events
+
+    def remove(self):
+        '''Kill anything the build left behind and remove the cgroup'''
+        if os.path.exists(self.file('cgroup.kill')):
+            _write(self.file('cgroup.kill'), 1)
+        for attempt in range(50):
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as e:
+                # EBUSY until the killed processes are gone
+                if e.errno != errno.EBUSY:
+                    break
+                time.sleep(0.1)
+        print('Could not remove cgroup', self.path)
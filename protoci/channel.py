@@ -0,0 +1,127 @@
+"""
+A local conda channel that builds of a run install each other's
+packages from, indexed one package at a time.
+
+conda index re-reads every package of a channel; LocalChannel.add reads
+only the new package (info/index.json from the start of the tarball,
+and its md5 in the same pass) and updates repodata kept in memory.
+"""
+from __future__ import print_function, division
+
+import bz2
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import threading
+
+INDEX = 'info/index.json'
+
+
+class _HashingReader(object):
+    '''File wrapper that hashes and counts what is read through it'''
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.md5.update(data)
+        self.size += len(data)
+        return data
+
+    def finish(self):
+        '''Hash the rest of the file, return (md5 hexdigest, size)'''
+        for chunk in iter(lambda: self.read(1 << 20), b''):
+            pass
+        return self.md5.hexdigest(), self.size
+
+
+def read_package(path):
+    '''
+    Return (info/index.json dict, md5, size) of the conda package at
+    path, reading it once: the tar stream is only decompressed up to
+    info/index.json (conda packages put info/ first), and the rest of
+    the file is only hashed.
+    '''
+    with open(path, 'rb') as f:
+        reader = _HashingReader(f)
+        index = None
+        with tarfile.open(fileobj=reader, mode='r|bz2') as tar:
+            for member in tar:
+                if member.name == INDEX:
+                    index = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                    break
+        if index is None:
+            raise ValueError('No {} in {}'.format(INDEX, path))
+        md5, size = reader.finish()
+    return index, md5, size
+
+
+class LocalChannel(object):
+    '''
+    Channel directory root with a <subdir>/repodata.json (and .bz2, for
+    older conda) per platform.  Existing repodata is loaded once; add()
+    copies a package in and rewrites only its subdir's repodata.
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.repodata = {}
+        self._lock = threading.Lock()
+        # conda expects noarch to exist in every channel
+        self._subdir('noarch')
+
+    @property
+    def url(self):
+        return 'file://' + self.root.replace(os.sep, '/')
+
+    def _subdir(self, subdir):
+        if subdir not in self.repodata:
+            path = os.path.join(self.root, subdir, 'repodata.json')
+            repodata = {'info': {'subdir': subdir}, 'packages': {}}
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    repodata = json.load(f)
+            self.repodata[subdir] = repodata
+            if not os.path.exists(path):
+                self._write(subdir)
+        return self.repodata[subdir]
+
+    def _write(self, subdir):
+        directory = os.path.join(self.root, subdir)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        data = json.dumps(self.repodata[subdir], indent=2, sort_keys=True).encode('utf-8')
+        for name, content in (('repodata.json', data),
+                              ('repodata.json.bz2', bz2.compress(data))):
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(content)
+            getattr(os, 'replace', os.rename)(path + '.tmp', path)
+
+    def add(self, path):
+        '''Add the conda package at path to the channel (if not already in it)'''
+        fn = os.path.basename(path)
+        index, md5, size = read_package(path)
+        subdir = index.get('subdir') or os.path.basename(os.path.dirname(os.path.abspath(path)))
+        with self._lock:
+            repodata = self._subdir(subdir)
+            entry = repodata['packages'].get(fn)
+            if entry is not None and entry.get('md5') == md5:
+                return
+            target = os.path.join(self.root, subdir, fn)
+            if os.path.abspath(path) != target:
+                if os.path.exists(target):
+                    os.remove(target)
+                try:
+                    os.link(path, target)
+                except (OSError, AttributeError):
+                    shutil.copy2(path, target)
+            index.update(md5=md5, size=size)
+            repodata['packages'][fn] = index
+            self._write(subdir)
+        print('Added {} to local channel {}'.format(fn, self.root))
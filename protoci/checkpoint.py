@@ -0,0 +1,108 @@
+from __future__ import print_function, division
+
+import datetime
+import json
+import os
+
+from protoci.build_cache import STATS
+
+
+class JournalResult(object):
+    '''Stands in for the PopenWrapper of a build finished by an earlier run'''
+
+    # Not built in this run, so not recorded to the resource profile again
+    cached = True
+
+    def __init__(self, entry):
+        self.returncode = entry.get('returncode')
+        if entry.get('status') == 'failed' and not self.returncode:
+            # Failed because a dependency failed
+            self.returncode = 1
+        self.output = entry.get('output')
+        self.finished = entry.get('time')
+        for k in STATS:
+            setattr(self, k, entry.get('stats', {}).get(k))
+
+    def __repr__(self):
+        return str({'resumed': True, 'returncode': self.returncode,
+                    'finished': self.finished})
+
+
+class Checkpoint(object):
+    '''
+    Journal of a make_deps run, one json object per line:
+
+    {"event": "start", "order": [...]} when a run starts,
+    {"package": p, "status": "done" | "failed", ...} as each package
+    finishes, with its returncode, output and build stats, and
+    {"event": "end", "pending": [...]} when the run stops.
+
+    Lines are flushed as they are written, so a killed run loses at most
+    the builds that were running.  With resume, the journal is appended
+    to and load() returns what earlier runs finished.
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            self.entries = self.load()
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        self._file = open(path, 'a' if resume else 'w')
+
+    def load(self):
+        '''Return {package: last journal entry} of finished packages'''
+        entries = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by a killed run
+                    continue
+                if 'package' in entry:
+                    entries[entry['package']] = entry
+        return entries
+
+    def finished(self, order, keys=None):
+        '''
+        Return {package: JournalResult} for packages of order that an
+        earlier run finished.  With keys ({package: build key}), packages
+        whose key changed since then are built again.
+        '''
+        results = {}
+        for pkg in order:
+            entry = self.entries.get(pkg)
+            if entry is None:
+                continue
+            if keys and entry.get('key') and entry['key'] != keys.get(pkg):
+                print('{} changed since checkpoint, building again'.format(pkg))
+                continue
+            results[pkg] = JournalResult(entry)
+        return results
+
+    def _write(self, entry):
+        entry['time'] = datetime.datetime.now().isoformat()
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def start(self, order):
+        self._write({'event': 'start', 'order': list(order)})
+
+    def record(self, package, result, failed, key=None):
+        entry = {'package': package,
+                 'status': 'failed' if failed else 'done',
+                 'returncode': getattr(result, 'returncode', None),
+                 'output': getattr(result, 'output', None),
+                 'stats': {k: getattr(result, k, None) for k in STATS}}
+        if key is not None:
+            entry['key'] = key
+        self._write(entry)
+        self.entries[package] = entry
+
+    def close(self, pending):
+        self._write({'event': 'end', 'pending': sorted(pending)})
+        self._file.close()
@@ -1,13 +1,17 @@
 from __future__ import print_function
 import argparse
 import json
+import os
 import subprocess
 import sys
 
-from protoci.build2 import (construct_graph, build_cli,
-                            last_changed_git_branch)
+from protoci.build2 import (construct_graph, build_cli, dirty, invalidate,
+                            last_changed_git_branch, git_merge_base,
+                            git_head, directory_key, PROTOCI_HOME)
 from protoci.sequential_build import sequential_build_main
 
+LAST_SUCCESS_DIR = os.path.join(PROTOCI_HOME, 'last_success')
+
 def checkout_last_changed(args):
     branch = last_changed_git_branch(args.path)
     cmd_line = ['git', 'checkout', branch]
@@ -31,9 +35,21 @@ def difference_build_cli(parse_this=None):
                         help='Dry run (store_true)')
     parser.add_argument('-depth',
                         default=1,
-                        type=int,
+                        type=depth_type,
                         help="Search depth for packages affected "
-                             "by git changes. (1 = 1 node away changes)")
+                             "by git changes. (1 = 1 node away changes, "
+                             "all = everything downstream)")
+    since = parser.add_mutually_exclusive_group()
+    since.add_argument('-since',
+                       help="Build recipes changed between this commit and "
+                            "HEAD instead of only those changed in HEAD.")
+    since.add_argument('-merge-base',
+                       help="Build recipes changed since the merge base of "
+                            "HEAD and this ref, e.g. origin/master for a PR.")
+    since.add_argument('-since-last-success',
+                       action='store_true',
+                       help="Build recipes changed since the last difference "
+                            "build of this directory without failures.")
     if not parse_this:
         args = parser.parse_args()
     args = parser.parse_args(parse_this)
@@ -44,23 +60,64 @@ def difference_build_cli(parse_this=None):
     vars(args2).update(vars(args))
     return args2
 
-def expand_dirty_label(g, changed=None):
-    changed = changed or set()
-    for node, value in g.node.items():
-        if value.get('dirty'):
-            changed.add(node)
-            for successor in g.predecessors(node):
-                changed.add(successor)
-                g.node[successor]['dirty'] = True
-    return changed
+def depth_type(value):
+    '''-depth is a number of steps or "all"'''
+    if value == 'all':
+        return None
+    return int(value)
+
+def _last_success_file(path):
+    return os.path.join(LAST_SUCCESS_DIR,
+                        directory_key(os.path.abspath(path)))
+
+def read_last_success(path):
+    '''Return the commit of the last failure free build of path, or None'''
+    try:
+        with open(_last_success_file(path), 'r') as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+def record_last_success(path, commit):
+    if not os.path.isdir(LAST_SUCCESS_DIR):
+        os.makedirs(LAST_SUCCESS_DIR)
+    with open(_last_success_file(path), 'w') as f:
+        f.write(commit)
+
+def git_base_of(args):
+    '''The commit to diff HEAD against, or None for only HEAD'''
+    if args.since:
+        return args.since
+    if args.merge_base:
+        return git_merge_base(args.merge_base, git_root=args.path)
+    if args.since_last_success:
+        base = read_last_success(args.path)
+        if base is None:
+            print('No successful build recorded yet, using HEAD only')
+        return base
+    return None
 
 def difference_build_main(parse_this=None):
     args = difference_build_cli(parse_this=parse_this)
-    g = construct_graph(args.path, filter_by_git_change=True)
-    changed = set()
-    for repeat in range(args.depth):
-        changed = expand_dirty_label(g, changed)
-    print('Full packages to test: ', json.dumps(list(changed)))
-    return sequential_build_main(parse_this=parse_this,
-                                 g=g,
-                                 args=None)
+    git_base = git_base_of(args)
+    head = git_head(args.path)
+    g = construct_graph(args.path, filter_by_git_change=True,
+                        incremental=True, git_base=git_base)
+    distance = invalidate(g, dirty(g, implicit=False), depth=args.depth)
+    print('Full packages to test: ', json.dumps(distance, sort_keys=True))
+    # Build exactly these (in dependency order) instead of
+    # letting build_order look at the dirty labels again
+    args.build = sorted(distance)
+    args.buildall = False
+    not_tested = []
+    if args.build:
+        failures = sequential_build_main(g=g, args=args)
+        not_tested = args.not_tested
+    else:
+        print('No packages affected by the git changes')
+        failures = 0
+    # Packages left untested (e.g. by a timeout) would be skipped
+    # by the next -since-last-success build
+    if not failures and not not_tested and not args.dry:
+        record_last_success(args.path, head)
+    return failures
@@ -0,0 +1,104 @@
+from __future__ import print_function, division
+
+import os
+import stat
+
+# Every full_every-th scan re-lists every directory; the scans in
+# between only re-list directories whose mtime changed.
+FULL_EVERY = 10
+
+
+def _entries(path):
+    '''Yield (path, is_dir, size) of the entries of path, not following links'''
+    scandir = getattr(os, 'scandir', None)
+    if scandir is not None:
+        it = scandir(path)
+        try:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.path, True, 0
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                # Hardlinks (e.g. from the conda package cache) take no space
+                yield entry.path, False, st.st_size if st.st_nlink == 1 else 0
+        finally:
+            getattr(it, 'close', lambda: None)()
+        return
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        st = os.lstat(full)
+        if stat.S_ISLNK(st.st_mode):
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            yield full, True, 0
+        else:
+            yield full, False, st.st_size if st.st_nlink == 1 else 0
+
+
+class DiskTracker(object):
+    '''
+    Track the peak size of the directories a build writes to.
+
+    paths is a list of directories, or a callable returning one (called on
+    every scan, so directories created during the build are picked up).
+    Sizes of directories whose mtime did not change since the last scan
+    are reused, so a scan only stats files in changed directories.  Files
+    growing in place do not change their directory's mtime, so every
+    FULL_EVERY-th scan re-lists everything.
+    '''
+
+    def __init__(self, paths, full_every=FULL_EVERY):
+        self.paths = paths
+        self.full_every = full_every
+        self.peak = 0
+        # Usage at the latest sample
+        self.last = 0
+        self._dirs = {}
+        self._scans = 0
+
+    def usage(self, full=False):
+        full = full or self._scans % self.full_every == 0
+        self._scans += 1
+        paths = self.paths() if callable(self.paths) else self.paths
+        seen = {}
+        total = 0
+        for path in set(os.path.abspath(p) for p in paths):
+            total += self._scan(path, full, seen)
+        # Forget directories that were removed
+        self._dirs = seen
+        return total
+
+    def sample(self, full=False):
+        '''Scan (everything, if full) and return the peak usage so far'''
+        self.last = self.usage(full)
+        self.peak = max(self.peak, self.last)
+        return self.peak
+
+    def _scan(self, top, full, seen):
+        total = 0
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+                cached = self._dirs.get(path)
+                if cached is not None and not full and cached[0] == mtime:
+                    size, subdirs = cached[1], cached[2]
+                else:
+                    size, subdirs = 0, []
+                    for entry, is_dir, entry_size in _entries(path):
+                        if is_dir:
+                            subdirs.append(entry)
+                        else:
+                            size += entry_size
+            except OSError:
+                # Removed while scanning
+                continue
+            seen[path] = (mtime, size, subdirs)
+            total += size
+            stack.extend(subdirs)
+        return total
@@ -0,0 +1,215 @@
+"""
+Executors run the subtrees of a split (the json of hi level package:
+build deps written by protoci-split-packages) somewhere and report back
+one record per package, with the fields of protoci.report.FIELDS plus
+the key of the subtree and the host it ran on.
+
+LocalExecutor runs protoci-sequential-build in local processes,
+SSHExecutor on hosts reachable with ssh; the anaconda.org build queue
+is protoci.submit.AnacondaExecutor.
+"""
+from __future__ import print_function, division
+
+from multiprocessing.pool import ThreadPool
+import json
+import os
+import shlex
+import subprocess
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from protoci.report import FIELDS
+
+BUILD_CMD = 'protoci-sequential-build'
+
+
+def tree_packages(tree, key):
+    '''Packages of subtree key in build order: its deps, then key'''
+    return list(tree[key]) + [key]
+
+
+def read_report(path):
+    '''Return the records of a json lines report, or None if it is missing'''
+    try:
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def package_records(packages, status, returncode=None):
+    '''Records for packages with no report of their own'''
+    records = []
+    for pkg in packages:
+        record = {k: None for k in FIELDS}
+        record.update(package=pkg, status=status, returncode=returncode,
+                      cached=False)
+        records.append(record)
+    return records
+
+
+class Executor(object):
+    '''
+    Base class of executors: run(key, packages) builds packages (in
+    order) of subtree key and returns a result dict with key, host,
+    returncode, log and records (one per package).  run is called from
+    up to slots threads at once.
+    '''
+
+    name = None
+    slots = 1
+
+    def run(self, key, packages):
+        raise NotImplementedError
+
+    def result(self, key, packages, returncode, records=None, host=None,
+               log=None, **extra):
+        if records is None:
+            # The run died before it wrote a report
+            records = package_records(packages, 'not_tested')
+        for record in records:
+            record.update(key=key, host=host)
+        result = {'key': key, 'host': host, 'returncode': returncode,
+                  'log': log, 'records': records}
+        result.update(extra)
+        return result
+
+
+class CommandExecutor(Executor):
+    '''
+    Executor running protoci-sequential-build (build_cmd) on a
+    directory of recipes, with its output in work_dir/<key>.log and its
+    report read back from work_dir/<key>.jsonl.
+    '''
+
+    def __init__(self, path, work_dir, build_cmd=BUILD_CMD, build_args=''):
+        self.path = path
+        self.work_dir = work_dir
+        self.build_cmd = shlex.split(build_cmd)
+        self.build_args = shlex.split(build_args)
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+    def command(self, path, packages, report):
+        return (self.build_cmd + [path, '--packages'] + list(packages) +
+                ['-report', report] + self.build_args)
+
+    def files(self, key):
+        safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in key)
+        base = os.path.join(self.work_dir, safe)
+        return base + '.log', base + '.jsonl'
+
+    def call(self, cmd, log):
+        with open(log, 'wb') as f:
+            return subprocess.call(cmd, stdout=f, stderr=subprocess.STDOUT)
+
+
+class LocalExecutor(CommandExecutor):
+    '''Runs up to workers subtrees at once as local processes'''
+
+    name = 'local'
+
+    def __init__(self, path, work_dir, workers=1, **kwargs):
+        super(LocalExecutor, self).__init__(path, work_dir, **kwargs)
+        self.slots = max(1, workers)
+
+    def run(self, key, packages):
+        log, report = self.files(key)
+        if os.path.exists(report):
+            os.remove(report)
+        returncode = self.call(self.command(self.path, packages, report), log)
+        return self.result(key, packages, returncode, read_report(report),
+                           host='localhost', log=log)
+
+
+class SSHExecutor(CommandExecutor):
+    '''
+    Runs subtrees on hosts (given as "host" or "host:slots") with ssh.
+    Each host needs protoci installed and a checkout of the recipes at
+    remote_path; reports are copied back with scp.
+    '''
+
+    name = 'ssh'
+
+    def __init__(self, hosts, remote_path, work_dir, ssh='ssh', scp='scp',
+                 **kwargs):
+        super(SSHExecutor, self).__init__(remote_path, work_dir, **kwargs)
+        self.ssh = shlex.split(ssh)
+        self.scp = shlex.split(scp)
+        self._hosts = queue.Queue()
+        for spec in hosts:
+            host, _, slots = spec.partition(':')
+            for _ in range(int(slots or 1)):
+                self._hosts.put(host)
+        self.slots = self._hosts.qsize()
+
+    def run(self, key, packages):
+        log, report = self.files(key)
+        remote_report = '.protoci-results/' + os.path.basename(report)
+        cmd = self.command('.', packages, remote_report)
+        remote = 'cd {} && mkdir -p .protoci-results && {}'.format(
+                 quote(self.path), ' '.join(quote(a) for a in cmd))
+        host = self._hosts.get()
+        try:
+            returncode = self.call(self.ssh + [host, remote], log)
+            if os.path.exists(report):
+                os.remove(report)
+            src = '{}:{}/{}'.format(host, self.path, remote_report)
+            with open(log, 'ab') as f:
+                subprocess.call(self.scp + ['-q', src, report],
+                                stdout=f, stderr=subprocess.STDOUT)
+        finally:
+            self._hosts.put(host)
+        return self.result(key, packages, returncode, read_report(report),
+                           host=host, log=log)
+
+
+def run_split(executor, tree, keys=None, results=None):
+    '''
+    Run the subtrees keys (default: all) of tree with executor, up to
+    executor.slots at once.  Returns the result dicts and writes their
+    records as json lines to results, if given.
+    '''
+    keys = list(tree) if keys is None else list(keys)
+    lock = threading.Lock()
+    out = open(results, 'w') if results else None
+
+    def run(key):
+        packages = tree_packages(tree, key)
+        print('Key: ', key, len(packages), 'packages to build/test')
+        try:
+            result = executor.run(key, packages)
+        except Exception as e:
+            print('Failed on', key, 'with:', repr(e))
+            result = executor.result(key, packages, 1, error=repr(e))
+        with lock:
+            print('Finished {} on {}: returncode {}'.format(
+                  key, result['host'], result['returncode']))
+            if out is not None:
+                for record in result['records']:
+                    out.write(json.dumps(record, sort_keys=True) + '\n')
+                out.flush()
+        return result
+
+    pool = ThreadPool(max(1, min(executor.slots, len(keys) or 1)))
+    try:
+        results = pool.map(run, keys)
+    finally:
+        pool.close()
+        pool.join()
+        if out is not None:
+            out.close()
+    print('SUMMARY ({} executor): key, host, returncode, TAIL or log'.format(
+          executor.name))
+    for result in results:
+        print('{}\t{}\t{}\t{}'.format(result['key'], result['host'],
+              result['returncode'], result.get('tail') or result['log']))
+    return results
@@ -0,0 +1,49 @@
+from __future__ import print_function, division
+
+import json
+import os
+
+SNAPSHOT_VERSION = 1
+
+
+class GraphSnapshot(object):
+    '''
+    The parsed recipes of a directory of recipes as of a git commit:
+    recipes maps recipe dir (relative to the directory) to
+    (package name, describe_meta dict) and errors maps recipe dir to
+    its parse error.
+    '''
+
+    def __init__(self, path, env_key=None):
+        self.path = path
+        self.env_key = env_key
+        self.commit = None
+        self.recipes = {}
+        self.errors = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except ValueError:
+                print('Ignoring corrupt graph snapshot', path)
+                return
+            if (data.get('version') == SNAPSHOT_VERSION and
+                    data.get('env_key') == env_key):
+                self.commit = data['commit']
+                self.recipes = {rd: tuple(info)
+                                for rd, info in data['recipes'].items()}
+                self.errors = data.get('errors', {})
+
+    def save(self, commit):
+        self.commit = commit
+        parent = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION,
+                       'env_key': self.env_key,
+                       'commit': commit,
+                       'recipes': self.recipes,
+                       'errors': self.errors}, f)
+        getattr(os, 'replace', os.rename)(tmp, self.path)
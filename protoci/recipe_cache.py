@@ -0,0 +1,123 @@
+from __future__ import print_function, division
+
+import hashlib
+import json
+import os
+
+CACHE_VERSION = 1
+
+
+def recipe_signature(recipe_dir):
+    '''
+    Return a sorted list of [relative path, size, mtime] for every
+    file in recipe_dir.  Cheap to compute: only stats the files.
+    '''
+    sig = []
+    for parent, dirs, files in os.walk(recipe_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for fil in files:
+            full = os.path.join(parent, fil)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            rel = os.path.relpath(full, recipe_dir).replace(os.sep, '/')
+            sig.append([rel, st.st_size, st.st_mtime])
+    sig.sort()
+    return sig
+
+
+def recipe_hash(recipe_dir, signature=None):
+    '''sha1 over the relative paths and contents of files in recipe_dir'''
+    if signature is None:
+        signature = recipe_signature(recipe_dir)
+    h = hashlib.sha1()
+    for rel, _, _ in signature:
+        h.update(rel.encode('utf-8'))
+        h.update(b'\0')
+        try:
+            with open(os.path.join(recipe_dir, rel), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    h.update(chunk)
+        except (IOError, OSError):
+            continue
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class RecipeCache(object):
+    '''
+    Json cache of parsed recipe info (package name and describe_meta
+    output) for one directory of recipes.
+
+    An entry is reused when the stat signature of its recipe directory
+    is unchanged, or when the signature changed (e.g. a fresh checkout)
+    but the content hash did not.  The whole cache is discarded when
+    env_key (the things recipe rendering depends on) changes.
+    '''
+
+    def __init__(self, path, env_key=None):
+        self.path = path
+        self.env_key = env_key
+        self.recipes = {}
+        self.hits = self.misses = 0
+        self._seen = set()
+        self._pending = {}
+        self._changed = False
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except ValueError:
+                print('Ignoring corrupt recipe cache', path)
+                data = {}
+            if (data.get('version') == CACHE_VERSION and
+                    data.get('env_key') == env_key):
+                self.recipes = data.get('recipes', {})
+
+    def get(self, recipe_dir):
+        '''Return (name, meta) for recipe_dir or None if it must be parsed'''
+        self._seen.add(recipe_dir)
+        sig = recipe_signature(recipe_dir)
+        entry = self.recipes.get(recipe_dir)
+        if entry and entry['stat'] == sig:
+            self.hits += 1
+            return entry['name'], entry['meta']
+        digest = recipe_hash(recipe_dir, sig)
+        if entry and entry['hash'] == digest:
+            entry['stat'] = sig
+            self._changed = True
+            self.hits += 1
+            return entry['name'], entry['meta']
+        self.misses += 1
+        self._pending[recipe_dir] = (sig, digest)
+        return None
+
+    def put(self, recipe_dir, name, meta):
+        self._seen.add(recipe_dir)
+        sig, digest = self._pending.pop(recipe_dir, (None, None))
+        if sig is None:
+            sig = recipe_signature(recipe_dir)
+            digest = recipe_hash(recipe_dir, sig)
+        self.recipes[recipe_dir] = {'stat': sig, 'hash': digest,
+                                    'name': name, 'meta': meta}
+        self._changed = True
+
+    def save(self, prune=True):
+        if prune:
+            # Forget recipes that no longer exist in the directory
+            for recipe_dir in set(self.recipes) - self._seen:
+                del self.recipes[recipe_dir]
+                self._changed = True
+        if not self._changed:
+            return
+        parent = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': CACHE_VERSION,
+                       'env_key': self.env_key,
+                       'recipes': self.recipes}, f)
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+        self._changed = False
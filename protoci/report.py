@@ -0,0 +1,110 @@
+from __future__ import print_function, division
+
+import csv
+import json
+import os
+import time
+
+# Columns of a report, in order
+FIELDS = ('package', 'status', 'returncode', 'cached', 'elapsed', 'queue_wait',
+          'rss', 'vms', 'disk', 'cpu_time', 'io_read', 'io_write', 'output',
+          'log_file')
+# Prometheus metric name, help text and report field of per-package gauges
+METRICS = (
+    ('protoci_build_elapsed_seconds', 'Wall clock time of the build', 'elapsed'),
+    ('protoci_build_queue_wait_seconds',
+     'Time between the build deps finishing and the build starting', 'queue_wait'),
+    ('protoci_build_rss_bytes', 'Peak resident memory of the build', 'rss'),
+    ('protoci_build_vms_bytes', 'Peak virtual memory of the build', 'vms'),
+    ('protoci_build_disk_bytes', 'Peak disk usage of the build', 'disk'),
+    ('protoci_build_cpu_seconds', 'User and system cpu time of the build', 'cpu_time'),
+    ('protoci_build_returncode', 'Return code of conda build', 'returncode'),
+)
+
+
+def build_records(build_times, success, failed, not_tested, timings=None):
+    '''
+    Return a list of one dict (see FIELDS) per package from the results of
+    make_deps.  timings is BuildScheduler.timings ({package: {'ready',
+    'start', 'end'}} of epoch times) and gives the queue wait.
+    '''
+    status = {}
+    status.update((pkg, 'not_tested') for pkg in not_tested)
+    status.update((pkg, 'failed') for pkg in failed)
+    status.update((pkg, 'success') for pkg in success)
+    timings = timings or {}
+    records = []
+    for pkg in sorted(set(build_times) | set(status)):
+        result = build_times.get(pkg)
+        record = {'package': pkg,
+                  'status': status.get(pkg, 'not_tested'),
+                  'cached': bool(getattr(result, 'cached', False))}
+        for k in FIELDS[4:]:
+            record[k] = getattr(result, k, None)
+        record['returncode'] = getattr(result, 'returncode', None)
+        times = timings.get(pkg, {})
+        if times.get('ready') is not None and times.get('start') is not None:
+            record['queue_wait'] = times['start'] - times['ready']
+        records.append(record)
+    return records
+
+
+def _atomic_write(path, write):
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        write(f)
+    getattr(os, 'replace', os.rename)(tmp, path)
+
+
+def write_report(path, records):
+    '''Write records as csv if path ends with .csv, otherwise as json lines'''
+    if path.endswith('.csv'):
+        def write(f):
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow({k: '' if record.get(k) is None else record[k]
+                                 for k in FIELDS})
+    else:
+        def write(f):
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+    _atomic_write(path, write)
+    print('Wrote build report', path)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prom(path, records, labels=None):
+    '''
+    Write records in the Prometheus text format, e.g. for the textfile
+    collector of node_exporter (the file is replaced atomically, as it
+    requires).  labels is a dict of labels added to every sample.
+    '''
+    extra = ''.join(',{}="{}"'.format(k, _label(v))
+                    for k, v in sorted((labels or {}).items()))
+    lines = []
+    for name, doc, field in METRICS:
+        lines.append('# HELP {} {}'.format(name, doc))
+        lines.append('# TYPE {} gauge'.format(name))
+        for record in records:
+            if record.get(field) is None or record['cached']:
+                continue
+            lines.append('{}{{package="{}"{}}} {}'.format(
+                         name, _label(record['package']), extra, record[field]))
+    lines.append('# HELP protoci_builds Number of packages by build status')
+    lines.append('# TYPE protoci_builds gauge')
+    for status in ('success', 'failed', 'not_tested'):
+        count = sum(1 for r in records if r['status'] == status)
+        lines.append('protoci_builds{{status="{}"{}}} {}'.format(status, extra, count))
+    lines.append('# HELP protoci_build_report_timestamp_seconds When the report was written')
+    lines.append('# TYPE protoci_build_report_timestamp_seconds gauge')
+    lines.append('protoci_build_report_timestamp_seconds{} {}'.format(
+                 '{' + extra.lstrip(',') + '}' if extra else '', time.time()))
+    _atomic_write(path, lambda f: f.write('\n'.join(lines) + '\n'))
+    print('Wrote build metrics', path)
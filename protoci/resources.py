@@ -0,0 +1,86 @@
+from __future__ import print_function, division
+
+import json
+import os
+
+# Measurements kept per package; predictions use the most recent ones.
+HISTORY = 5
+STATS = ('elapsed', 'rss', 'vms', 'disk')
+
+
+class ResourceProfile(object):
+    '''
+    Per-package history of PopenWrapper measurements (elapsed, rss,
+    vms, disk) persisted as json so that schedulers can predict what
+    a build will need before starting it.
+    '''
+
+    def __init__(self, path=None, history=HISTORY):
+        self.path = path
+        self.history = history
+        self.packages = {}
+        self._default = None
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.packages = json.load(f)
+
+    def record(self, package, result):
+        '''Add the stats of a finished PopenWrapper for package'''
+        if result is None or getattr(result, 'returncode', 1):
+            # Failed builds often stop early and under-report
+            return
+        sample = {k: getattr(result, k, None) for k in STATS}
+        if all(v is None for v in sample.values()):
+            return
+        samples = self.packages.setdefault(package, [])
+        samples.append(sample)
+        del samples[:-self.history]
+        self._default = None
+
+    def predict(self, package):
+        '''
+        Return a dict of predicted elapsed, rss, vms and disk for package.
+
+        Peaks (rss, vms, disk) are the max over the recorded history,
+        elapsed is the mean.  Stats without history get the median
+        prediction of all known packages (or 0 when nothing is known).
+        '''
+        pred = dict(self.default())
+        pred.update(self._known(package))
+        return pred
+
+    def _known(self, package):
+        pred = {}
+        samples = self.packages.get(package) or []
+        for k in STATS:
+            values = [max(s[k], 0) for s in samples if s.get(k) is not None]
+            if not values:
+                continue
+            elif k == 'elapsed':
+                pred[k] = sum(values) / len(values)
+            else:
+                pred[k] = max(values)
+        return pred
+
+    def default(self):
+        if self._default is None:
+            known = [self._known(p) for p in self.packages]
+            self._default = {}
+            for k in STATS:
+                values = sorted(p[k] for p in known if k in p)
+                self._default[k] = values[len(values) // 2] if values else 0
+        return self._default
+
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.packages, f, indent=1, sort_keys=True)
+        getattr(os, 'replace', os.rename)(tmp, path)
+        print('Saved resource profile of {} packages to {}'.format(
+              len(self.packages), path))
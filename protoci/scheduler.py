@@ -0,0 +1,288 @@
+from __future__ import print_function, division
+
+import heapq
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def critical_paths(graph, order, cost):
+    '''
+    Return {pkg: length of the longest chain from pkg to the end of the
+    build} for pkgs in order (deps first), where the length of a chain is
+    the sum of cost(pkg) over its packages.  A package with a long
+    critical path holds up a lot of work behind it.
+    '''
+    in_order = set(order)
+    paths = {}
+    for pkg in reversed(order):
+        # The packages that build-depend on pkg come later in order
+        waiting = [paths[p] for p in graph.predecessors(pkg)
+                   if p in in_order and p != pkg]
+        paths[pkg] = cost(pkg) + max(waiting or [0])
+    return paths
+
+
+def critical_path_order(graph, order, cost):
+    '''
+    Return order (deps first) rearranged so that, of the packages whose
+    deps are built, the one with the longest critical path comes first.
+    '''
+    paths = critical_paths(graph, order, cost)
+    index = {pkg: idx for idx, pkg in enumerate(order)}
+    waiting, dependents = {}, dict((pkg, []) for pkg in order)
+    for pkg in order:
+        deps = [d for d in graph.successors(pkg) if d in index and d != pkg]
+        waiting[pkg] = len(deps)
+        for d in deps:
+            dependents[d].append(pkg)
+    ready = [(-paths[pkg], index[pkg], pkg) for pkg in order if not waiting[pkg]]
+    heapq.heapify(ready)
+    new_order = []
+    while ready:
+        _, _, pkg = heapq.heappop(ready)
+        new_order.append(pkg)
+        for dependent in dependents[pkg]:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                heapq.heappush(ready, (-paths[dependent], index[dependent], dependent))
+    return new_order
+
+
+class BuildScheduler(object):
+    '''
+    Run build_fn for every package in order, launching a package as soon
+    as all of its build deps (successors in graph that are also in order)
+    have finished.  At most jobs builds run at once.
+
+    With jobs=1 builds run in the calling thread, one after another,
+    in the given order.
+
+    If a ResourceProfile is given, a ready package is only started while
+    the predicted rss and disk of all running builds stay within max_mem
+    and max_disk (bytes).  A package is always started when nothing else
+    is running, so an over-budget package can not stall the run.  The
+    profile's predicted build times are also used to print an ETA and the
+    packages projected to miss the timeout after every build.
+
+    finished is {pkg: result} of packages finished by an earlier run
+    (see protoci.checkpoint), which are counted as succeeded or failed
+    without building them again.  on_finish(pkg, result, failed) is
+    called as each package of this run finishes.
+
+    timings holds {pkg: {'ready', 'start', 'end'}} epoch times of the
+    packages of this run, for the queue wait between a package's deps
+    finishing and its build starting.
+    '''
+
+    def __init__(self, graph, order, build_fn, jobs=1, autofail=True,
+                 jobtimeout=3600, timeoutbuffer=600, profile=None,
+                 max_mem=None, max_disk=None, finished=None, on_finish=None):
+        self.graph = graph
+        self.order = list(order)
+        self.build_fn = build_fn
+        self.jobs = max(1, jobs or 1)
+        self.autofail = autofail
+        self.jobtimeout = jobtimeout
+        self.timeoutbuffer = timeoutbuffer
+        self.profile = profile
+        self.max_mem = max_mem
+        self.max_disk = max_disk
+        self.finished = finished or {}
+        self.on_finish = on_finish
+
+        self.index = {pkg: idx for idx, pkg in enumerate(self.order)}
+        self.deps = {}
+        self.dependents = {pkg: [] for pkg in self.order}
+        for pkg in self.order:
+            deps = [d for d in graph.successors(pkg)
+                    if d in self.index and d != pkg]
+            self.deps[pkg] = deps
+            for d in deps:
+                self.dependents[d].append(pkg)
+
+        self.success = set()
+        self.failed = set()
+        self.not_tested = set()
+        self.build_times = {pkg: None for pkg in self.order}
+        self.timings = {}
+        self._waiting = {pkg: len(deps) for pkg, deps in self.deps.items()}
+        self._ready = []
+        self._running = set()
+        self._started = {}
+        self._reserved = {}
+        self._done = queue.Queue()
+        self._stop = False
+
+    def run(self):
+        self._start = time.time()
+        for pkg, result in self.finished.items():
+            self.build_times[pkg] = result
+            if result is None or result.returncode:
+                self.failed.add(pkg)
+            else:
+                self.success.add(pkg)
+        if self.finished:
+            print('Resuming: {} succeeded and {} failed in earlier runs'.format(
+                  len(self.success), len(self.failed)))
+        for pkg in self.order:
+            if pkg in self.finished:
+                continue
+            self._waiting[pkg] = sum(1 for d in self.deps[pkg]
+                                     if d not in self.finished)
+            if not self._waiting[pkg]:
+                self._push_ready(pkg)
+        try:
+            self._launch_ready()
+            while self._running:
+                self._finish(*self._next_done())
+                self._launch_ready()
+        except KeyboardInterrupt:
+            print('KeyboardInterrupt')
+            self._stop_launching()
+        self.not_tested.update(pkg for pkg in self.order
+                               if pkg not in self.success and
+                               pkg not in self.failed)
+        return (list(self.success), list(self.failed),
+                list(self.not_tested), self.build_times)
+
+    def _push_ready(self, pkg):
+        self.timings[pkg] = {'ready': time.time()}
+        heapq.heappush(self._ready, self.index[pkg])
+
+    def _next_done(self):
+        while True:
+            try:
+                # A timeout keeps the main thread responsive to Ctrl-C
+                return self._done.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _launch_ready(self):
+        deferred = []
+        while self._ready and not self._stop and len(self._running) < self.jobs:
+            pkg = self.order[heapq.heappop(self._ready)]
+            failed_deps = [d for d in self.deps[pkg] if d in self.failed]
+            if failed_deps and self.autofail:
+                print("Building {} failed because one or more of its "
+                      "dependencies failed to build: ".format(pkg), end=' ')
+                print(', '.join(failed_deps))
+                self._finish(pkg, None, None)
+                continue
+            if not self._admit(pkg):
+                deferred.append(self.index[pkg])
+                continue
+            print("Building ", pkg)
+            self._running.add(pkg)
+            self._started[pkg] = self.timings[pkg]['start'] = time.time()
+            if self.jobs == 1:
+                self._build(pkg)
+            else:
+                thread = threading.Thread(target=self._build, args=(pkg,),
+                                          name='build-{}'.format(pkg))
+                thread.daemon = True
+                thread.start()
+        for idx in deferred:
+            heapq.heappush(self._ready, idx)
+
+    def _admit(self, pkg):
+        if self.profile is None:
+            return True
+        pred = self.profile.predict(pkg)
+        need = (pred['rss'], pred['disk'])
+        if self._running:
+            mem = sum(r[0] for r in self._reserved.values()) + need[0]
+            disk = sum(r[1] for r in self._reserved.values()) + need[1]
+            if ((self.max_mem and mem > self.max_mem) or
+                    (self.max_disk and disk > self.max_disk)):
+                return False
+        self._reserved[pkg] = need
+        return True
+
+    def _build(self, pkg):
+        try:
+            result = self.build_fn(self.graph.node[pkg])
+            self._done.put((pkg, result, None))
+        except KeyboardInterrupt:
+            self._done.put((pkg, None, 'KeyboardInterrupt'))
+            raise
+        except subprocess.CalledProcessError as e:
+            self._done.put((pkg, None, e))
+        except Exception as e:
+            print('Failed on make_pkg for', pkg, 'with:', repr(e))
+            self._done.put((pkg, None, e))
+
+    def _finish(self, pkg, result, error):
+        self._running.discard(pkg)
+        self._reserved.pop(pkg, None)
+        self.timings.setdefault(pkg, {})['end'] = time.time()
+        self.build_times[pkg] = result
+        if self.profile is not None and not getattr(result, 'cached', False):
+            self.profile.record(pkg, result)
+        if error is not None or result is None or result.returncode:
+            self.failed.add(pkg)
+        else:
+            self.success.add(pkg)
+        if self.on_finish is not None and error != 'KeyboardInterrupt':
+            # An interrupted build is left pending
+            self.on_finish(pkg, result, pkg in self.failed)
+        for dependent in self.dependents[pkg]:
+            self._waiting[dependent] -= 1
+            if not self._waiting[dependent]:
+                self._push_ready(dependent)
+        elapsed = time.time() - self._start
+        if not self._stop and elapsed > self.jobtimeout - self.timeoutbuffer:
+            self._stop_launching()
+            print('TIMEOUT within protoci, NOT_TESTED',
+                  set(self.order) - self.success - self.failed - self._running)
+        elif self.profile is not None:
+            self._report_eta()
+
+    def _project(self):
+        '''
+        Return {pkg: predicted finish time} for unfinished packages by
+        simulating the rest of the run with the profile's build times.
+        '''
+        now = time.time()
+        slots = []
+        finish = {}
+        for pkg in self._running:
+            elapsed = now - self._started[pkg]
+            finish[pkg] = now + max(0, self.profile.predict(pkg)['elapsed'] - elapsed)
+            slots.append(finish[pkg])
+        slots += [now] * (self.jobs - len(slots))
+        heapq.heapify(slots)
+        for pkg in self.order:
+            if pkg in finish or pkg in self.success or pkg in self.failed:
+                continue
+            if self.autofail and any(d in self.failed for d in self.deps[pkg]):
+                # Fails as soon as it is reached
+                continue
+            ready = max([finish.get(d, now) for d in self.deps[pkg]] + [now])
+            start = max(heapq.heappop(slots), ready)
+            finish[pkg] = start + self.profile.predict(pkg)['elapsed']
+            heapq.heappush(slots, finish[pkg])
+        return finish
+
+    def _report_eta(self):
+        finish = self._project()
+        if not finish:
+            return
+        now = time.time()
+        deadline = self._start + self.jobtimeout - self.timeoutbuffer
+        late = sorted(pkg for pkg, t in finish.items() if t > deadline)
+        print('ETA {:.0f}s: {} done, {} running, {} waiting'.format(
+              max(finish.values()) - now,
+              len(self.success) + len(self.failed), len(self._running),
+              len(finish) - len(self._running)))
+        if late:
+            print('Projected NOT_TESTED: [{}]'.format(', '.join(late)))
+
+    def _stop_launching(self):
+        # Builds already running are allowed to finish; nothing new starts.
+        self._stop = True
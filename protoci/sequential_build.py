@@ -1,9 +1,14 @@
 import argparse
+import json
+import os
 import sys
 
 from protoci.build2 import (make_pkg, make_deps,
                             construct_graph, pre_build_clean_up,
                             bytes2human, build_cli)
+from protoci import report as build_report
+from protoci.buildroot import pkgs_environ
+from protoci.channel import LocalChannel
 
 
 
@@ -31,12 +36,14 @@ def sequential_build_main(parse_this=None, g=None, args=None):
                 using args.build or args.buildall
                 to build a package or packages
                 with
+        Returns: the number of packages that failed; those not
+            tested are left in args.not_tested
     '''
     from protoci.split import make_package_tree_main
     if args is None:
         args = build_cli(parse_this=parse_this)
     if g is None:
-        g = construct_graph(args.path, filter_by_git_diff=False)
+        g = construct_graph(args.path, filter_by_git_change=False)
     pre_build_clean_up(args)
     try:
         if args.buildall:
@@ -67,45 +74,89 @@ def sequential_build_main(parse_this=None, g=None, args=None):
             # of list to end
             packages = args.packages
         build_times = {x: None for x in packages}
-        success, fail = [], []
+        success, fail, not_tested = [], [], []
         if packages:
-            for package in packages:
-                package = g.node[package]
+            env = pkgs_environ(args.pkgs_dir) if args.pkgs_dir else None
+            channel = None
+            cbargs = args.cbargs
+            if args.local_channel and not args.dry:
+                channel = LocalChannel(args.local_channel)
+                cbargs = '{} -c {}'.format(cbargs, channel.url).strip()
+            for name in packages:
+                package = g.node[name]
                 if not 'meta' in package:
                     continue
-                build_time = None
                 try:
-                    print('BUILD_PACKAGE:', package)
-                    build_time = make_pkg(package, dry=args.dry,
-                                          extra_args=args.cbargs)
-                    success.append(package)
+                    print('BUILD_PACKAGE:', name)
+                    build_times[name] = make_pkg(package, dry=args.dry,
+                                                 extra_args=cbargs,
+                                                 log_dir=args.log_dir,
+                                                 env=env)
                 except Exception as e:
-                    print('Failed on make_pkg for', package, 'with:', repr(e))
-                    fail.append(package)
-                build_time = time.time() - build_time
-                build_times[package] = build_time
+                    print('Failed on make_pkg for', name, 'with:', repr(e))
+                if getattr(build_times[name], 'returncode', 1):
+                    fail.append(name)
+                    continue
+                success.append(name)
+                output = getattr(build_times[name], 'output', None)
+                if channel is not None and output and os.path.exists(output):
+                    # Later packages of the list may need it
+                    try:
+                        channel.add(output)
+                    except Exception as e:
+                        print('Could not add', output, 'to the local channel:',
+                              repr(e))
+            records = build_report.build_records(build_times, success,
+                                                 fail, not_tested)
+            if args.report:
+                build_report.write_report(args.report, records)
+            if args.prom:
+                build_report.write_prom(args.prom, records)
         else:
             # using -build or -buildall flags
             print('call make_deps from sequential_build_main')
-            success, fail, not_tested, times = make_deps(g, args.build, args.dry,
+            success, fail, not_tested, build_times = make_deps(g, args.build, args.dry,
                                              extra_args=args.cbargs,
                                              level=args.level,
-                                             autofail=args.autofail)
+                                             autofail=args.autofail,
+                                             jobs=args.jobs,
+                                             profile=args.profile,
+                                             max_mem=args.max_mem,
+                                             max_disk=args.max_disk,
+                                             cgroup=args.cgroup,
+                                             build_mem_limit=args.build_mem_limit,
+                                             build_cpu_limit=args.build_cpu_limit,
+                                             build_cache=args.build_cache,
+                                             critical_path=args.critical_path,
+                                             checkpoint=args.checkpoint,
+                                             resume=args.resume,
+                                             report=args.report,
+                                             prom=args.prom,
+                                             timeline=args.timeline,
+                                             log_dir=args.log_dir,
+                                             pkgs_dir=args.pkgs_dir,
+                                             local_channel=args.local_channel)
         print("BUILD SUMMARY:")
         print("SUCCESS: [{}]".format(', '.join(success)))
         print("FAIL: [{}]".format(', '.join(fail)))
         print("NOT_TESTED: [{}]".format(', '.join(not_tested)))
+        # The return value only counts failures
+        args.not_tested = not_tested
 
-        # Sum memory usage and print elapsed times.
+        # Max memory usage and total elapsed time of the builds run
         r, v, e = 0, 0, 0
         print("Build stats: Package, Elapsed time, Mem Usage, Disk Usage")
-        for k, i in times.items():
-            rss = getattr(i, 'rss', -1)
-            vms = getattr(i, 'vms', -1)
-            r, v = max(rss, r), max(vms, r)
-            e += getattr(i, 'elapsed', -1)
-            disk = getattr(i, 'disk', -1)
-            print("{}\t\t{:.2f}s\t{}\t{}".format(k, e, bytes2human(rss), bytes2human(disk)))
+        for k, i in sorted(build_times.items()):
+            if i is None:
+                continue
+            rss = getattr(i, 'rss', None) or 0
+            vms = getattr(i, 'vms', None) or 0
+            elapsed = getattr(i, 'elapsed', None) or 0
+            disk = getattr(i, 'disk', None) or 0
+            r, v = max(rss, r), max(vms, v)
+            if not getattr(i, 'cached', False):
+                e += elapsed
+            print("{}\t\t{:.2f}s\t{}\t{}".format(k, elapsed, bytes2human(rss), bytes2human(disk)))
         r, v = bytes2human(r), bytes2human(v)
         print("Max Memory Usage (RSS/VMS): {}/{}".format(r, v))
         print("Total elapsed time: {:.2f}m".format(e/60))
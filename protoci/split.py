@@ -1,25 +1,75 @@
+from __future__ import division
 import argparse
 from collections import defaultdict
 import json
+import math
 import sys
 
 import networkx as nx
 
-from protoci.build2 import construct_graph
+from protoci.build2 import construct_graph, RESOURCE_PROFILE, bytes2human
+from protoci.resources import ResourceProfile
 
-def successors_iter(g, s, nodes):
-    for s in sorted(g.successors(s)):
-        nodes.append(s)
-        for s in tuple(successors_iter(g, s, nodes)):
-            nodes.append(s)
-    nodes2 = []
-    for n in nodes:
-        if nodes2.count(n) == 0:
-            nodes2.append(n)
-    return nodes2
+def successors_iter(g, s, nodes=None):
+    '''
+    Return all descendants of s (packages s depends on, directly or not)
+    in depth first preorder with successors visited in sorted order.
+    Every node is visited once.  nodes is an optional list of nodes
+    that come first in the result and are not visited again.
+    '''
+    nodes = list(nodes or [])
+    seen = set(nodes)
+    stack = [iter(sorted(g.successors(s)))]
+    while stack:
+        for n in stack[-1]:
+            if n in seen:
+                continue
+            seen.add(n)
+            nodes.append(n)
+            stack.append(iter(sorted(g.successors(n))))
+            break
+        else:
+            stack.pop()
+    return nodes
+
+def descendant_bits(g, toposort):
+    '''
+    Return {node: int} where bit i of the int is set if toposort[i]
+    is a descendant of node.
+
+    Each node's closure is the union of its successors' closures, so
+    closures are computed once in reverse topological order and shared
+    by every package that depends on them.
+    '''
+    rank = {n: i for i, n in enumerate(toposort)}
+    bits = {}
+    for n in reversed(toposort):
+        b = 0
+        for s in g.successors(n):
+            b |= bits[s] | (1 << rank[s])
+        bits[n] = b
+    return bits
+
+def bits_to_nodes(b, toposort):
+    '''Return the nodes of bitset b, highest bit (last in toposort) first'''
+    digits = bin(b)[2:]
+    top = len(digits) - 1
+    nodes = []
+    pos = digits.find('1')
+    while pos != -1:
+        nodes.append(toposort[top - pos])
+        pos = digits.find('1', pos + 1)
+    return nodes
 
 def coalesce(hi_level_builds, targetnum):
     coalesced = defaultdict(lambda: [])
+    seen = defaultdict(set)
+
+    def extend(key, g):
+        new = [gi for gi in g if gi not in seen[key] and gi != key]
+        coalesced[key] += new
+        seen[key].update(new)
+
     counts = [(k, len(v)) for k, v in hi_level_builds.items()]
     group = []
     for key, count in sorted(counts, key=lambda x:(x[1], x[0])):
@@ -28,31 +78,112 @@ def coalesce(hi_level_builds, targetnum):
             for g in group:
                 if g == key:
                     continue
-                coalesced[key] += [gi for gi in g if gi not in coalesced[key] and gi != key]
+                extend(key, g)
             group = []
     if group:
         for g in group:
-            coalesced[key] += [gi for gi in g if gi not in coalesced[key] and gi != key]
+            extend(key, g)
     return coalesced
 
-def split_graph(g, targetnum, split_file):
+def coalesce_balanced(hi_level_builds, targetnum, profile, max_time=None):
+    '''
+    Like coalesce, but balance the predicted build time of submissions.
+
+    Each high level package and its deps is a unit.  Units are placed
+    longest first, and packages a submission already builds cost nothing
+    to add to it.  Predictions come from profile (a ResourceProfile).
+
+    With max_time (seconds), a unit goes to the submission it adds the
+    least time to without passing max_time, and a new submission is
+    started when none fits.  Otherwise there are (number of packages /
+    targetnum) submissions and a unit goes to the one with the lowest
+    predicted time afterwards (LPT).  Ties go to the submission with the
+    lower predicted peak memory.
+    '''
+    def cost(pkg):
+        # Without any history every package costs the same
+        return profile.predict(pkg)['elapsed'] or 1
+
+    units = {key: deps + [key] for key, deps in hi_level_builds.items()}
+    unit_cost = {key: sum(cost(p) for p in set(unit))
+                 for key, unit in units.items()}
+    if max_time:
+        # Submissions are opened as needed to stay under max_time
+        nbins = 0
+    else:
+        nbins = int(math.ceil(sum(map(len, units.values())) / targetnum))
+        nbins = max(1, min(nbins, len(units)))
+
+    # (predicted time, predicted peak memory) of each submission
+    loads = [(0, 0)] * nbins
+    bins = [[] for _ in range(nbins)]
+    members = [set() for _ in range(nbins)]
+    for key in sorted(units, key=lambda k: (-unit_cost[k], k)):
+        unit = units[key]
+        best = None
+        for i, (load, mem) in enumerate(loads):
+            added = set(unit) - members[i]
+            new_load = load + sum(cost(p) for p in added)
+            if max_time and new_load > max_time:
+                continue
+            new_mem = max([mem] + [profile.predict(p)['rss'] for p in added])
+            # Least added time, or least resulting time (LPT)
+            rank = (new_load - load if max_time else new_load, new_mem, i)
+            if best is None or rank < best[0]:
+                best = (rank, new_load, new_mem)
+        if best is None:
+            loads.append((0, 0))
+            bins.append([])
+            members.append(set())
+            i, new_load = len(loads) - 1, unit_cost[key]
+            new_mem = max(profile.predict(p)['rss'] for p in unit)
+        else:
+            i, new_load, new_mem = best[0][2], best[1], best[2]
+        loads[i] = (new_load, new_mem)
+        bins[i].append(key)
+        members[i].update(unit)
+
+    coalesced = defaultdict(lambda: [])
+    for i, (load, mem) in enumerate(loads):
+        if not bins[i]:
+            continue
+        key = bins[i][-1]
+        seen = set([key])
+        for k in bins[i]:
+            for p in units[k]:
+                if p not in seen:
+                    coalesced[key].append(p)
+                    seen.add(p)
+        print('Submission {}: {} packages, predicted {:.0f}s, peak memory {}'.format(
+              key, len(seen), load, bytes2human(mem)))
+        if max_time and load > max_time:
+            print('WARNING: {} is predicted to take longer than {}s'.format(key, max_time))
+    return coalesced
+
+def split_graph(g, targetnum, split_file, profile=None, max_time=None):
     g = g.copy()
-    toposort = nx.topological_sort(g)
+    toposort = list(nx.topological_sort(g))
     packages_covered = defaultdict(lambda:0)
     degrees = dict(g.degree_iter())
 
+    closures = descendant_bits(g, toposort)
+
     hi_level_builds = {}
-    for hi_level in nx.topological_sort(g):
+    for hi_level in toposort:
         if hi_level in packages_covered:
             continue
-        succ = tuple(successors_iter(g, hi_level, []))
+        # Bits are topological ranks, so this is already ordered
+        # deepest dependency first
+        succ = bits_to_nodes(closures[hi_level], toposort)
         for s in succ:
             packages_covered[s] += 1
         packages_covered[hi_level] += 1
-        topo_order = [(s, toposort.index(s)) for s in succ]
-        succ_order = sorted(topo_order, key=lambda x: -x[1])
-        hi_level_builds[hi_level] = [_[0] for _ in succ_order]
-    hi_level_builds = coalesce(hi_level_builds, targetnum)
+        hi_level_builds[hi_level] = succ
+    if profile is not None:
+        hi_level_builds = coalesce_balanced(hi_level_builds, targetnum,
+                                            profile, max_time=max_time)
+    else:
+        hi_level_builds = coalesce(hi_level_builds, targetnum)
     with open(split_file, 'w') as f:
         f.write(json.dumps(hi_level_builds))
     return hi_level_builds
@@ -70,6 +201,19 @@ def make_package_tree_cli(parse_this=None):
     parser.add_argument('-s','--split-files',
                         type=str,
                         default="package_tree.js")
+    parser.add_argument('-balance',
+                        action='store_true',
+                        help="Balance submissions by build time and memory "
+                             "recorded in -profile instead of package count.")
+    parser.add_argument('-profile',
+                        default=RESOURCE_PROFILE,
+                        help="Json file of per-package build resource history. "
+                             "Default: %(default)s")
+    parser.add_argument('-max-time',
+                        type=float,
+                        help="With -balance, target seconds of building per "
+                             "submission, e.g. the anaconda-build job timeout "
+                             "less a buffer.")
     if not parse_this:
         return parser.parse_args()
     return parser.parse_args(parse_this)
@@ -77,7 +221,9 @@ def make_package_tree_cli(parse_this=None):
 def make_package_tree_main(parse_this=None, exit=True):
     args = make_package_tree_cli(parse_this=parse_this)
     g = construct_graph(args.path)
-    hi_level_builds = split_graph(g, args.targetnum, args.split_files)
+    profile = ResourceProfile(args.profile) if args.balance else None
+    hi_level_builds = split_graph(g, args.targetnum, args.split_files,
+                                  profile=profile, max_time=args.max_time)
     print("See ", args.split_files, 'for split packages')
     if exit:
         sys.exit(0)
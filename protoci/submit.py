@@ -1,16 +1,80 @@
 import argparse
+import copy
 import datetime
 import json
 import shutil
+import shlex
 import subprocess
 import os
 import sys
+import threading
 
-from protoci.build2 import pre_build_clean_up
+from protoci.build2 import construct_graph, pre_build_clean_up
+from protoci.executors import (Executor, LocalExecutor, SSHExecutor,
+                               BUILD_CMD, package_records, run_split)
 
-def submit_one(args):
+# The anaconda client; a stub can stand in for it in tests
+ANACONDA = os.environ.get('PROTOCI_ANACONDA', 'anaconda')
+
+def anaconda_cmd(args, *cmd):
+    return shlex.split(getattr(args, 'anaconda_exe', None) or ANACONDA) + list(cmd)
+
+
+def package_exists(args, full_package):
+    '''True if full_package exists on anaconda.org'''
+    cmd = anaconda_cmd(args, 'build', 'list-all', full_package)
+    print('Check to see if', full_package, 'exists:', cmd)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    proc.communicate()
+    return proc.returncode == 0
+
+
+def binstar_template():
+    '''The compiled jinja2 template of .binstar.yml'''
+    import jinja2
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'binstar_template.yml')) as f:
+        return jinja2.Template(f.read())
+
+
+def recipe_dirs(path):
+    '''Return {package name: recipe directory} of the recipes in path'''
+    g = construct_graph(path, filter_by_git_change=False)
+    return {pkg: g.node[pkg]['recipe'] for pkg in g.nodes_iter()
+            if g.node[pkg].get('recipe')}
+
+
+def link_tree(src, dst):
+    '''Recreate src at dst with hardlinks, copying where links fail'''
+    for parent, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(parent, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for fil in files:
+            source = os.path.join(parent, fil)
+            try:
+                os.link(source, os.path.join(target, fil))
+            except (OSError, AttributeError):
+                # Another file system (or no os.link on Windows and py2)
+                shutil.copy2(source, os.path.join(target, fil))
+
+
+def stage_recipes(path, recipes, staging):
+    '''
+    Make staging a directory holding only recipes (directories in path),
+    at the same place relative to staging as they are in path.
+    '''
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    for recipe in recipes:
+        link_tree(recipe, os.path.join(staging, os.path.relpath(recipe, path)))
+    return staging
+
+
+def submit_one(args, exists=None, template=None, recipes=None):
     '''
-    Adjusts binstar_template.yml
+    Adjusts binstar_template.yml (or template, its compiled jinja2 Template)
     base on
         user
         queue
@@ -18,65 +82,137 @@ def submit_one(args):
         platforms
     Comes up with a package name for user
     Creates package if it doesn't exist
-    Submits package
+        (exists(full_package) is used instead of package_exists if given)
+    Stages the recipes of the key's packages (recipes is {package: recipe
+        dir}, see recipe_dirs) and the .binstar.yml in a directory of its
+        own under args.work_dir, so submissions do not share files
+    Submits package from there
     Prints out the command you need to tail the build
-    returns 0 if okay
+    returns (returncode, tail command), returncode 0 if okay
     '''
-    import jinja2
     js_file, key = args.json_file_key
     with open(js_file, 'r') as f:
         js = json.load(f)
-    with open(os.path.join(os.path.dirname(__file__), 'data', 'binstar_template.yml')) as f:
-        packages = js[key] + [key]
-        contents = f.read()
-        t = jinja2.Template(contents)
-        package = 'protoci-' + key
-        info = (os.path.basename(js_file), key)
-        platforms = "".join(" - {}\n".format(p) for p in args.platforms)
-        packages = " ".join('"{}"'.format(p) for p in packages)
-        build_args = '{} --packages {}'.format('.', packages)
-        if args.dry:
-            build_args += ' -dry'
-        binstar_yml = t.render(PACKAGE=package,
-                               USER=args.user,
-                               PLATFORMS=platforms,
-                               BUILD_ARGS=build_args)
-        with open(os.path.join(args.path, '.binstar.yml'), 'w') as f:
-            f.write(binstar_yml)
+    t = template or binstar_template()
+    recipes = recipes or recipe_dirs(args.path)
+    names = js[key] + [key]
+    package = 'protoci-' + key
+    info = (os.path.basename(js_file), key)
+    platforms = "".join(" - {}\n".format(p) for p in args.platforms)
+    packages = " ".join('"{}"'.format(p) for p in names)
+    build_args = '{} --packages {}'.format('.', packages)
+    if args.dry:
+        build_args += ' -dry'
+    binstar_yml = t.render(PACKAGE=package,
+                           USER=args.user,
+                           PLATFORMS=platforms,
+                           BUILD_ARGS=build_args)
     full_package = '{0}/{1}'.format(args.user, package)
-    cmd = ['anaconda', 'build', 'list-all', full_package]
-    print('Check to see if', full_package, 'exists:', cmd)
-    proc = subprocess.Popen(cmd)
-    if proc.wait():
-        cmd = ['anaconda', 'package','--create', full_package]
+    if not (exists or (lambda p: package_exists(args, p)))(full_package):
+        cmd = anaconda_cmd(args, 'package', '--create', full_package)
         print("prepare to create package", cmd)
         if not args.dry:
             create = subprocess.Popen(cmd, cwd=args.path)
             if create.wait():
                 raise ValueError('Could not create {}'.format(full_package))
 
+    safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in key)
+    staging = stage_recipes(args.path,
+                            [recipes[name] for name in names if name in recipes],
+                            os.path.join(getattr(args, 'work_dir', None) or 'protoci-submit',
+                                         'stage', safe))
+    with open(os.path.join(staging, '.binstar.yml'), 'w') as f:
+        f.write(binstar_yml)
     user_queue = '{0}/{1}'.format(args.user, args.queue)
-    cmd = ['anaconda', 'build',
-           'submit', './', '--queue',
-           user_queue]
+    cmd = anaconda_cmd(args, 'build',
+                       'submit', './', '--queue',
+                       user_queue)
     for label in getattr(args, 'labels', []) or []:
         cmd.extend(('--label', label))
-    print('prepare to submit', cmd)
+    print('prepare to submit', cmd, 'from', staging)
     if args.dry:
-        return 0
-    proc =  subprocess.Popen(cmd, cwd=args.path, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    ret = proc.wait()
-    out = proc.stdout.read().decode()
+        # Left in place to look at
+        return 0, None
+    try:
+        proc = subprocess.Popen(cmd, cwd=staging, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        out = proc.communicate()[0].decode()
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
     tail = [line for line in out.split('\n')
             if 'tail' in line and full_package in line]
     if len(tail):
         tail = tail[0]
     else:
         print("Apparently something wrong with:", out)
-        time.sleep(10)
+        tail = None
     print('TAIL:\t', tail)
-    return ret
+    return proc.returncode, tail
+
+
+class AnacondaExecutor(Executor):
+    '''
+    Submits subtrees to the anaconda.org build queue with submit_one, up
+    to workers at once.  The builds run later on the queue, so records
+    only say whether the submission worked.  Whether a package exists on
+    anaconda.org is looked up once per run, and the recipes are read and
+    the .binstar.yml template compiled once.
+    '''
+
+    name = 'anaconda'
+
+    def __init__(self, args, json_file, workers=1):
+        self.args = args
+        self.json_file = json_file
+        self.slots = max(1, workers)
+        self._exists = {}
+        # A lock per package, so lookups of different packages run at once
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.template = binstar_template()
+        self.recipes = recipe_dirs(args.path)
+
+    def _lock(self, full_package):
+        with self._locks_lock:
+            return self._locks.setdefault(full_package, threading.Lock())
+
+    def exists(self, full_package):
+        with self._lock(full_package):
+            if full_package not in self._exists:
+                self._exists[full_package] = package_exists(self.args, full_package)
+            exists = self._exists[full_package]
+            if not self.args.dry:
+                # Created by submit_one if it did not exist
+                self._exists[full_package] = True
+        return exists
+
+    def run(self, key, packages):
+        args = copy.copy(self.args)
+        args.json_file_key = (self.json_file, key)
+        try:
+            ret, tail = submit_one(args, exists=self.exists,
+                                   template=self.template, recipes=self.recipes)
+        except Exception:
+            # The package may not have been created after all
+            self._exists.pop('{}/protoci-{}'.format(args.user, key), None)
+            raise
+        status = 'failed' if ret else 'submitted'
+        return self.result(key, packages, ret,
+                           package_records(packages, status, ret),
+                           host=self.args.queue, tail=tail)
+
+
+def make_executor(args, json_file):
+    '''Return the Executor chosen by args.executor for subtrees in json_file'''
+    if args.executor == 'anaconda':
+        return AnacondaExecutor(args, json_file, workers=args.workers)
+    build_args = args.build_args + (' -dry' if args.dry else '')
+    if args.executor == 'local':
+        return LocalExecutor(args.path, args.work_dir, workers=args.workers,
+                             build_cmd=args.build_cmd, build_args=build_args)
+    return SSHExecutor(args.hosts, args.remote_path or args.path,
+                       args.work_dir, build_cmd=args.build_cmd,
+                       build_args=build_args)
 
 
 def submit_full_json(args):
@@ -86,14 +222,12 @@ def submit_full_json(args):
     '''
     with open(args.full_json, 'r') as f:
         tree = json.load(f)
-        print('{} high level packages'.format(len(tree)))
-        print('\twith total packages:',
-              len(tree) + sum(map(len, tree.values())))
-        for key in tree:
-            print('Key: ', key, len(tree[key])+1, 'packages to build/test')
-            args.json_file_key = (args.full_json, key)
-            submit_one(args)
-    return 0
+    print('{} high level packages'.format(len(tree)))
+    print('\twith total packages:',
+          len(tree) + sum(map(len, tree.values())))
+    results = run_split(make_executor(args, args.full_json), tree,
+                        results=args.results)
+    return sum(1 for result in results if result['returncode'])
 
 
 def submit_helper(args):
@@ -104,11 +238,13 @@ def submit_helper(args):
         assert len(args.json_file_key) >= 2
         arg1 = args.json_file_key[0]
         hi_level = args.json_file_key[1:]
-        for key in hi_level:
-            args.json_file_key = (arg1, key)
-            ret_val = submit_one(args)
-            if ret_val:
-                return ret_val
+        with open(arg1, 'r') as f:
+            tree = json.load(f)
+        results = run_split(make_executor(args, arg1), tree, hi_level,
+                            results=args.results)
+        for result in results:
+            if result['returncode']:
+                return result['returncode']
     return 0
 
 
@@ -135,9 +271,8 @@ def submit_cli(parse_this=None):
                         action='store_true',
                         help='Dry run')
     parser.add_argument('-platforms',
-                        required=True,
-                        help="Some of all of %(default)s",
-                        default=['osx-64', 'linux-64','win-64'],
+                        help="Some of all of osx-64 linux-64 win-64 "
+                             "(required with -executor anaconda)",
                         nargs="+")
     parser.add_argument('--targetnum','-t',
                         help="The --targetnum argument that was given to protoci-split-packages",
@@ -147,9 +282,52 @@ def submit_cli(parse_this=None):
                              "(formerly called channels).\n\tDefault: %(default)s",
                         nargs="+",
                         default=['dev'])
+    parser.add_argument('-executor',
+                        choices=('anaconda', 'local', 'ssh'),
+                        default='anaconda',
+                        help="Where to build the subtrees: the anaconda.org "
+                             "build queue, local processes or ssh hosts. "
+                             "Default: %(default)s")
+    parser.add_argument('-workers',
+                        type=int,
+                        default=1,
+                        help="Subtrees built (-executor local) or submitted "
+                             "(-executor anaconda) at once. Default: %(default)s")
+    parser.add_argument('-anaconda-exe',
+                        default=ANACONDA,
+                        help="anaconda client command (or $PROTOCI_ANACONDA). "
+                             "Default: %(default)s")
+    parser.add_argument('-hosts',
+                        nargs="+",
+                        default=[],
+                        help="Hosts for -executor ssh, as host or host:slots")
+    parser.add_argument('-remote-path',
+                        help="Directory of the recipes on the -hosts. "
+                             "Default: same as path")
+    parser.add_argument('-work-dir',
+                        default='protoci-submit',
+                        help="Logs and reports of -executor local and ssh, "
+                             "staged recipes of -executor anaconda. "
+                             "Default: %(default)s")
+    parser.add_argument('-build-cmd',
+                        default=BUILD_CMD,
+                        help="Build command of -executor local and ssh. "
+                             "Default: %(default)s")
+    parser.add_argument('-build-args',
+                        default='',
+                        help="Extra arguments to -build-cmd, e.g. \"-j 4\"")
+    parser.add_argument('-results',
+                        help="Write one json line per package "
+                             "(see protoci.report) to this file")
     if not parse_this:
-        return parser.parse_args()
-    return parser.parse_args(parse_this)
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(parse_this)
+    if args.executor == 'anaconda' and not args.platforms:
+        parser.error('-platforms is required with -executor anaconda')
+    if args.executor == 'ssh' and not args.hosts:
+        parser.error('-executor ssh needs -hosts')
+    return args
 
 
 def submit_main(parse_this=None, exit=True):
@@ -158,4 +336,5 @@ def submit_main(parse_this=None, exit=True):
     ret_val = submit_helper(args)
     if exit:
         sys.exit(ret_val)
+    return ret_val
 
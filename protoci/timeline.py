@@ -0,0 +1,197 @@
+"""
+Resource time series of builds and a Gantt chart of a run.
+
+make_deps(timeline=FILE) writes one json line per build: its start and
+end times, return code and the samples PopenWrapper took while it ran
+(seconds since start, rss bytes, cpu percent, disk bytes and rss per
+process name).  protoci-timeline renders such a file as an svg.
+"""
+from __future__ import print_function, division
+
+import argparse
+from array import array
+import json
+import os
+import threading
+from xml.sax.saxutils import escape
+
+# Gantt chart layout (pixels)
+WIDTH = 1200
+ROW = 18
+LABEL = 200
+USAGE = 120
+# Process names with less peak rss than this share the 'other' series
+MIN_PROC_RSS = 1 << 20
+
+
+def _mib(n):
+    return '{:.0f}M'.format(n / (1 << 20))
+
+
+class Series(object):
+    '''
+    Samples of one build, kept in arrays (8 bytes a value) rather than
+    lists of floats since a long build is sampled many thousand times.
+    procs maps process name (gcc, ld, python) to its rss, one value per
+    sample like the other series.
+    '''
+
+    def __init__(self):
+        self.start = None
+        self.times = array('d')
+        self.rss = array('d')
+        self.cpu = array('d')
+        self.disk = array('d')
+        self.procs = {}
+
+    def add(self, t, rss, cpu, disk=None, procs=None):
+        if self.start is None:
+            self.start = t
+        n = len(self.times)
+        self.times.append(t - self.start)
+        self.rss.append(rss or 0)
+        self.cpu.append(cpu or 0)
+        self.disk.append(disk or 0)
+        procs = procs or {}
+        for name in procs:
+            if name not in self.procs:
+                self.procs[name] = array('d', [0] * n)
+        for name, values in self.procs.items():
+            values.append(procs.get(name, 0))
+
+    def to_dict(self):
+        procs, other = {}, None
+        for name, values in self.procs.items():
+            if max(values) >= MIN_PROC_RSS:
+                procs[name] = values.tolist()
+            elif other is None:
+                other = array('d', values)
+            else:
+                for i, v in enumerate(values):
+                    other[i] += v
+        if other is not None:
+            procs['other'] = other.tolist()
+        return {'start': self.start, 'times': self.times.tolist(),
+                'rss': self.rss.tolist(), 'cpu': self.cpu.tolist(),
+                'disk': self.disk.tolist(), 'procs': procs}
+
+
+class Timeline(object):
+    '''Json lines file of the Series of each build of a run'''
+
+    def __init__(self, path):
+        self.path = path
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def add(self, package, series, result):
+        record = series.to_dict()
+        record.update(package=package,
+                      end=(series.start or 0) + (getattr(result, 'elapsed', None) or 0),
+                      returncode=getattr(result, 'returncode', None))
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_timeline(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _usage(records, t0, t1, steps):
+    '''Total rss and cpu of all builds at steps points from t0 to t1'''
+    rss, cpu = [0.0] * steps, [0.0] * steps
+    span = (t1 - t0) or 1
+    for rec in records:
+        times = rec['times']
+        for i in range(len(times)):
+            # A sample holds until the next one (or the end of the build)
+            a = rec['start'] + times[i]
+            b = rec['start'] + times[i + 1] if i + 1 < len(times) else rec['end']
+            lo = int((a - t0) / span * (steps - 1))
+            hi = int((b - t0) / span * (steps - 1))
+            for step in range(max(lo, 0), min(hi, steps - 1) + 1):
+                rss[step] += rec['rss'][i]
+                cpu[step] += rec['cpu'][i]
+    return rss, cpu
+
+
+def _polyline(points, color, width=1):
+    return '<polyline fill="none" stroke="{}" stroke-width="{}" points="{}"/>'.format(
+           color, width, ' '.join('{:.1f},{:.1f}'.format(x, y) for x, y in points))
+
+
+def render_svg(records, out):
+    '''
+    Write an svg Gantt chart of records (see read_timeline): a bar per
+    build (green succeeded, red failed) with its rss over time drawn
+    inside, and below, the total rss and cpu of the run over time.
+    '''
+    records = sorted((r for r in records if r.get('start') is not None),
+                     key=lambda r: r['start'])
+    if not records:
+        raise ValueError('No builds with samples in the timeline')
+    t0 = min(r['start'] for r in records)
+    t1 = max(r['end'] for r in records)
+    span = (t1 - t0) or 1
+    plot = WIDTH - LABEL - 10
+
+    def x(t):
+        return LABEL + (t - t0) / span * plot
+
+    peak = max(max(r['rss'] or [0]) for r in records) or 1
+    height = ROW * len(records) + USAGE + 60
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" '
+           'font-family="sans-serif" font-size="11">'.format(WIDTH, height)]
+    for row, rec in enumerate(records):
+        y = 10 + row * ROW
+        color = '#d9534f' if rec.get('returncode') else '#5cb85c'
+        svg.append('<text x="{}" y="{}" text-anchor="end">{}</text>'.format(
+                   LABEL - 5, y + ROW - 5, escape(rec['package'])))
+        svg.append('<rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" fill="{}" '
+                   'opacity="0.5"><title>{} {:.0f}s peak {}</title></rect>'.format(
+                   x(rec['start']), y + 1, max(x(rec['end']) - x(rec['start']), 1),
+                   ROW - 2, color, escape(rec['package']), rec['end'] - rec['start'],
+                   _mib(max(rec['rss'] or [0]))))
+        points = [(x(rec['start'] + t), y + ROW - 1 - v / peak * (ROW - 2))
+                  for t, v in zip(rec['times'], rec['rss'])]
+        if points:
+            svg.append(_polyline(points, '#333'))
+    top = 20 + ROW * len(records)
+    steps = plot // 2
+    rss, cpu = _usage(records, t0, t1, steps)
+    max_rss, max_cpu = max(rss) or 1, max(cpu) or 1
+    svg.append('<text x="{}" y="{}" text-anchor="end">rss (peak {})</text>'.format(
+               LABEL - 5, top + USAGE // 2 - 6, _mib(max_rss)))
+    svg.append('<text x="{}" y="{}" text-anchor="end" fill="#337ab7">'
+               'cpu (peak {:.0f}%)</text>'.format(LABEL - 5, top + USAGE // 2 + 8, max_cpu))
+    for values, top_value, color in ((rss, max_rss, '#333'), (cpu, max_cpu, '#337ab7')):
+        svg.append(_polyline([(LABEL + i / (steps - 1) * plot,
+                               top + USAGE - v / top_value * USAGE)
+                              for i, v in enumerate(values)], color, 1.5))
+    svg.append('<text x="{}" y="{}">0s</text>'.format(LABEL, top + USAGE + 15))
+    svg.append('<text x="{}" y="{}" text-anchor="end">{:.0f}s</text>'.format(
+               WIDTH - 10, top + USAGE + 15, span))
+    svg.append('</svg>')
+    with open(out, 'w') as f:
+        f.write('\n'.join(svg) + '\n')
+    print('Wrote', out)
+
+
+def timeline_main(parse_this=None):
+    parser = argparse.ArgumentParser(description="Render a build timeline "
+                                     "(see -timeline of protoci-sequential-build) as svg")
+    parser.add_argument('timeline')
+    parser.add_argument('-o', '--output',
+                        help="Default: the timeline file name with .svg")
+    args = parser.parse_args(parse_this)
+    out = args.output or os.path.splitext(args.timeline)[0] + '.svg'
+    render_svg(read_timeline(args.timeline), out)
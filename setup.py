@@ -35,7 +35,8 @@ setup(
           'protoci-sequential-build = protoci.sequential_build:sequential_build_main',
           'protoci-difference-build = protoci.difference_build:difference_build_main',
           'protoci-split-packages = protoci.split:make_package_tree_main',
-          'protoci-submit = protoci.submit:submit_main'
+          'protoci-submit = protoci.submit:submit_main',
+          'protoci-timeline = protoci.timeline:timeline_main'
           ],
     }
 )